@@ -0,0 +1,215 @@
+import time
+import numpy as np
+
+
+class IVFIndex(object):
+  """
+  An approximate nearest neighbor index for L2 distance based on an inverted
+  file (IVF): a k-means coarse quantizer splits the data into num_lists cells,
+  and a query is only compared against the points in the nprobe cells whose
+  centroids are closest to it. Larger nprobe gives better recall at the cost
+  of latency; nprobe == num_lists is an exact search.
+
+  Points can be added after the index is built; they are assigned to the
+  existing cells without retraining the quantizer.
+  """
+
+  def __init__(self, num_lists=64, nprobe=4, num_iters=10, max_train=20000,
+               block_size=4096, seed=0):
+    """
+    Inputs:
+    - num_lists: Number of k-means cells in the coarse quantizer.
+    - nprobe: Default number of cells to visit per query.
+    - num_iters: Number of Lloyd iterations used to train the quantizer.
+    - max_train: Maximum number of points sampled to train the quantizer.
+    - block_size: Number of rows processed at a time when assigning points.
+    - seed: Seed for the random sampling and initialization of centroids.
+    """
+    self.num_lists = num_lists
+    self.nprobe = nprobe
+    self.num_iters = num_iters
+    self.max_train = max_train
+    self.block_size = block_size
+    self.seed = seed
+    self.centroids = None
+    self.ntotal = 0
+
+  def fit(self, X):
+    """
+    Train the coarse quantizer on X and add all of X to the index. Any points
+    already in the index are discarded.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) of data points; the ith point gets id i.
+    """
+    rng = np.random.RandomState(self.seed)
+    N = X.shape[0]
+    num_lists = min(self.num_lists, N)
+    sample = X[rng.choice(N, min(N, self.max_train), replace=False)]
+    sample = sample.astype(np.float64)
+    centroids = sample[rng.choice(sample.shape[0], num_lists, replace=False)]
+
+    for it in xrange(self.num_iters):
+      assign = self._nearest_centroids(sample, centroids, 1)[:, 0]
+      order = np.argsort(assign, kind='mergesort')
+      counts = np.bincount(assign, minlength=num_lists)
+      nonempty = counts > 0
+      starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+      sums = np.add.reduceat(sample[order], starts, axis=0)
+      # Empty cells keep their previous centroid
+      centroids[nonempty] = sums / counts[nonempty, np.newaxis]
+
+    self.centroids = centroids
+    self._list_chunks = [[] for _ in xrange(num_lists)]
+    self._lists = [None] * num_lists
+    self.ntotal = 0
+    self.add(X)
+
+  def add(self, X):
+    """
+    Add points to a trained index. The new points get ids ntotal, ntotal + 1,
+    and so on, in the order they appear in X.
+
+    Inputs:
+    - X: A numpy array of shape (M, D) of data points.
+    """
+    if self.centroids is None:
+      raise ValueError('The index must be trained with fit before adding points')
+    ids = np.arange(self.ntotal, self.ntotal + X.shape[0])
+    assign = self._nearest_centroids(X, self.centroids, 1)[:, 0]
+    for c in np.unique(assign):
+      mask = assign == c
+      self._list_chunks[c].append((ids[mask], X[mask]))
+      self._lists[c] = None
+    self.ntotal += X.shape[0]
+
+  def search(self, X, k=1, nprobe=None):
+    """
+    Find approximate k nearest neighbors of each query.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) of queries.
+    - k: The number of neighbors to return.
+    - nprobe: The number of cells to visit per query; defaults to self.nprobe.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of L2 distances, sorted in
+      increasing order. If fewer than k points were visited the remaining
+      entries are inf.
+    - ids: An integer array of shape (num_test, k) of the ids of the neighbors;
+      missing neighbors have id -1.
+    """
+    if nprobe is None:
+      nprobe = self.nprobe
+    num_lists = self.centroids.shape[0]
+    nprobe = min(nprobe, num_lists)
+    num_test = X.shape[0]
+    probes = self._nearest_centroids(X, self.centroids, nprobe)
+    X_norms = np.einsum('ij,ij->i', X, X)
+
+    best_d = np.empty((num_test, k))
+    best_d.fill(np.inf)
+    best_i = -np.ones((num_test, k), dtype=np.intp)
+    # Group the queries by the cells they probe
+    probe_order = np.argsort(probes.ravel(), kind='mergesort')
+    bounds = np.searchsorted(probes.ravel()[probe_order], np.arange(num_lists + 1))
+    for c in xrange(num_lists):
+      queries = probe_order[bounds[c]:bounds[c + 1]] // nprobe
+      if queries.size == 0:
+        continue
+      ids, vectors, norms = self._get_list(c)
+      if ids.size == 0:
+        continue
+      d2 = X[queries].dot(vectors.T)
+      d2 *= -2.0
+      d2 += X_norms[queries, np.newaxis]
+      d2 += norms
+      np.maximum(d2, 0, out=d2)
+      cand_d = np.hstack([best_d[queries], d2])
+      cand_i = np.hstack([best_i[queries],
+                          np.tile(ids, (queries.size, 1))])
+      order = np.lexsort((cand_i, cand_d))[:, :k]
+      rows = np.arange(queries.size)[:, np.newaxis]
+      best_d[queries] = cand_d[rows, order]
+      best_i[queries] = cand_i[rows, order]
+
+    return np.sqrt(best_d), best_i
+
+  def _get_list(self, c):
+    """
+    Return (ids, vectors, squared norms) for cell c, merging any chunks that
+    were added since the cell was last searched.
+    """
+    if self._lists[c] is None:
+      chunks = self._list_chunks[c]
+      if chunks:
+        ids = np.concatenate([chunk[0] for chunk in chunks])
+        vectors = np.concatenate([chunk[1] for chunk in chunks])
+      else:
+        ids = np.zeros(0, dtype=np.intp)
+        vectors = np.zeros((0, self.centroids.shape[1]))
+      self._list_chunks[c] = [(ids, vectors)]
+      self._lists[c] = (ids, vectors, np.einsum('ij,ij->i', vectors, vectors))
+    return self._lists[c]
+
+  def _nearest_centroids(self, X, centroids, n):
+    """
+    Return an integer array of shape (N, n) giving the indices of the n
+    nearest centroids to each row of X, processed block_size rows at a time.
+    """
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    nearest = np.empty((X.shape[0], n), dtype=np.intp)
+    for i0 in xrange(0, X.shape[0], self.block_size):
+      # |x|^2 is constant along each row, so it does not change the ranking
+      scores = centroid_norms - 2.0 * X[i0:i0 + self.block_size].dot(centroids.T)
+      if n < centroids.shape[0]:
+        scores_idx = np.argpartition(scores, n - 1, axis=1)[:, :n]
+      else:
+        scores_idx = np.tile(np.arange(centroids.shape[0]), (scores.shape[0], 1))
+      rows = np.arange(scores.shape[0])[:, np.newaxis]
+      order = np.argsort(scores[rows, scores_idx], axis=1)
+      nearest[i0:i0 + self.block_size] = scores_idx[rows, order]
+    return nearest
+
+
+def benchmark_index(classifier, X, k=10, nprobes=(1, 2, 4, 8, 16),
+                    verbose=True):
+  """
+  Compare the approximate index of a trained KNearestNeighbor against exact
+  search with compute_distances_no_loops, reporting recall@k and queries per
+  second. Use a few thousand CIFAR-10 test rows as X to get realistic numbers.
+
+  Inputs:
+  - classifier: A KNearestNeighbor that was trained with an index.
+  - X: A numpy array of shape (num_test, D) of queries.
+  - k: The number of neighbors used for recall@k.
+  - nprobes: Values of nprobe to try.
+  - verbose: Boolean; if true, print one line per setting.
+
+  Returns:
+  A list of dictionaries, one for exact search and one per nprobe, with keys
+  'method', 'nprobe', 'recall', 'qps' and 'seconds'.
+  """
+  num_test = X.shape[0]
+  tic = time.time()
+  dists = classifier.compute_distances_no_loops(X)
+  _, exact = classifier.select_neighbors(dists, k=k)
+  exact_time = time.time() - tic
+  del dists
+
+  results = [{'method': 'exact', 'nprobe': None, 'recall': 1.0,
+              'qps': num_test / exact_time, 'seconds': exact_time}]
+  for nprobe in nprobes:
+    tic = time.time()
+    _, approx = classifier.index.search(X, k=k, nprobe=nprobe)
+    seconds = time.time() - tic
+    hits = sum(np.intersect1d(exact[i], approx[i]).size for i in xrange(num_test))
+    results.append({'method': 'ivf', 'nprobe': nprobe,
+                    'recall': float(hits) / (num_test * k),
+                    'qps': num_test / seconds, 'seconds': seconds})
+
+  if verbose:
+    for r in results:
+      print '%-5s nprobe=%-4s recall@%d=%.4f  %.1f queries/sec' % (
+          r['method'], r['nprobe'], k, r['recall'], r['qps'])
+  return results
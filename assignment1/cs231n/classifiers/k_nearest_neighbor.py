@@ -1,14 +1,66 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
-from scipy import stats
+from cs231n.shared_memory import share_array, open_shared_array
+from cs231n.shared_memory import release_shared_array
+
+
+def _merge_smallest(dists, idxs, k):
+    """
+    Keep the k smallest entries of each row of dists, ordered by distance and
+    then by index; idxs holds the training index of every entry.
+    """
+    order = np.lexsort((idxs, dists))[:, :k]
+    rows = np.arange(dists.shape[0])[:, np.newaxis]
+    return dists[rows, order], idxs[rows, order]
+
+
+def _distance_dtype(dtype, X_dtype):
+    """
+    Return the dtype in which distances on data of dtype X_dtype are computed:
+    dtype if it is set, and otherwise X_dtype, promoted to float64 for
+    integer or boolean data so that products such as those of uint8 pixels
+    do not overflow.
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    if np.dtype(X_dtype).kind in 'biu':
+        return np.dtype(np.float64)
+    return np.dtype(X_dtype)
+
+
+def _squared_norms(X, dtype=None):
+    """
+    Return the squared L2 norm of every row of X, computed in the dtype given
+    by _distance_dtype.
+    """
+    X = X.astype(_distance_dtype(dtype, X.dtype), copy=False)
+    return np.einsum('ij,ij->i', X, X)
 
 
 class KNearestNeighbor(object):
     """ a kNN classifier with L2 distance """
 
-    def __init__(self):
-        pass
+    def __init__(self, memory_budget=256 * 1024 ** 2, dtype=None):
+        """
+        Inputs:
+        - memory_budget: Approximate number of bytes that the blocked distance
+          engine may use for a single tile of distances; see
+          iter_distance_blocks.
+        - dtype: Optional numpy datatype used to compute distances. None keeps
+          the dtype of the data (float64 after load_CIFAR10), except that
+          integer data such as raw uint8 pixels is converted to float64 so the
+          products cannot overflow. np.float32 halves
+          the memory traffic. np.int32 computes exact distances for integer
+          pixel data such as uint8 images, at the cost of a non-BLAS product.
+          Any dtype other than that of the training data keeps a converted
+          copy of the training set.
+        """
+        self.memory_budget = memory_budget
+        self.dtype = dtype
 
-    def train(self, X, y):
+    def train(self, X, y, X_norms=None, index=None):
         """
         Train the classifier. For k-nearest neighbors this is just
         memorizing the training data.
@@ -18,11 +70,48 @@ class KNearestNeighbor(object):
           consisting of num_train samples each of dimension D.
         - y: A numpy array of shape (N,) containing the training labels, where
              y[i] is the label for X[i].
+        - X_norms: Optional array of shape (num_train,) holding the squared L2
+          norm of every row of X, if the caller has already computed it.
+        - index: Optional approximate nearest neighbor index, such as
+          cs231n.ann_index.IVFIndex, which is built on X here and used by
+          predict(..., approximate=True).
         """
         self.X_train = X
         self.y_train = y
+        # Training data in the dtype used to compute distances
+        self.X_compute = X.astype(_distance_dtype(self.dtype, X.dtype),
+                                  copy=False)
+        # Squared norms of the training points; these are shared by every call
+        # to the vectorized and blocked distance functions.
+        if X_norms is None:
+            X_norms = _squared_norms(self.X_compute, self.dtype)
+        self.X_train_norms = X_norms
+        self.num_classes = np.max(y) + 1
+        self.index = index
+        if index is not None:
+            index.fit(X)
 
-    def predict(self, X, k=1, num_loops=0):
+    def add(self, X, y):
+        """
+        Add more training points to a trained classifier. If the classifier has
+        an index, the new points are added to it without rebuilding it.
+
+        Inputs:
+        - X: A numpy array of shape (num_new, D) of training data.
+        - y: A numpy array of shape (num_new,) of training labels.
+        """
+        self.X_train = np.concatenate([self.X_train, X])
+        self.y_train = np.concatenate([self.y_train, y])
+        self.X_compute = self.X_train.astype(
+            _distance_dtype(self.dtype, self.X_train.dtype), copy=False)
+        self.X_train_norms = np.concatenate([self.X_train_norms,
+                                             _squared_norms(X, self.dtype)])
+        self.num_classes = max(self.num_classes, np.max(y) + 1)
+        if self.index is not None:
+            self.index.add(X)
+
+    def predict(self, X, k=1, num_loops=0, blocked=False, approximate=False,
+                nprobe=None, n_jobs=1):
         """
         Predict labels for test data using this classifier.
 
@@ -32,11 +121,31 @@ class KNearestNeighbor(object):
         - k: The number of nearest neighbors that vote for the predicted labels.
         - num_loops: Determines which implementation to use to compute distances
           between training points and testing points.
+        - blocked: If True, ignore num_loops and find the neighbors with the
+          blocked distance engine, which never builds the full distance matrix.
+        - approximate: If True, find the neighbors with the index passed to
+          train instead of an exact search.
+        - nprobe: Number of index cells to visit per query when approximate is
+          True; trades recall for latency. Defaults to the index setting.
+        - n_jobs: Number of worker threads used to shard the test set; -1 uses
+          every core. Any value other than 1 implies blocked.
 
         Returns:
         - y: A numpy array of shape (num_test,) containing predicted labels for the
           test data, where y[i] is the predicted label for the test point X[i].
         """
+        if approximate:
+            if self.index is None:
+                raise ValueError('No index was built; pass index= to train')
+            _, neighbors = self.index.search(X, k=k, nprobe=nprobe)
+            return self.vote_labels(neighbors)
+        if n_jobs != 1:
+            _, neighbors = self.kneighbors_parallel(X, k=k, n_jobs=n_jobs)
+            return self.vote_labels(neighbors)
+        if blocked:
+            _, neighbors = self.kneighbors(X, k=k)
+            return self.vote_labels(neighbors)
+
         if num_loops == 0:
             dists = self.compute_distances_no_loops(X)
         elif num_loops == 1:
@@ -48,6 +157,23 @@ class KNearestNeighbor(object):
 
         return self.predict_labels(dists, k=k)
 
+    def predict_multi_k(self, X, ks):
+        """
+        Predict labels for test data for several values of k at once. The
+        distances are computed in a single blocked pass that keeps max(ks)
+        neighbors, and every k votes with a prefix of the same sorted list.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - ks: A list of the numbers of neighbors to try.
+
+        Returns:
+        A dictionary mapping each k in ks to a numpy array of shape (num_test,)
+        of predicted labels; these equal predict(X, k=k, blocked=True).
+        """
+        _, neighbors = self.kneighbors(X, k=max(ks))
+        return dict((k, self.vote_labels(neighbors[:, :k])) for k in ks)
+
     def compute_distances_two_loops(self, X):
         """
         Compute the distance between each test point in X and each training point
@@ -105,13 +231,19 @@ class KNearestNeighbor(object):
             #######################################################################
         return dists
 
-    def compute_distances_no_loops(self, X):
+    def compute_distances_no_loops(self, X, squared=False):
         """
         Compute the distance between each test point in X and each training point
         in self.X_train using no explicit loops.
 
-        Input / Output: Same as compute_distances_two_loops
+        The computation is done in self.dtype if it is set (see __init__), and
+        negative squared distances caused by cancellation are clamped to zero.
+
+        Input / Output: Same as compute_distances_two_loops, except that if
+        squared is True the squared distances are returned; they rank the
+        training points the same way and skip the square root.
         """
+        X = X.astype(_distance_dtype(self.dtype, X.dtype), copy=False)
         num_test = X.shape[0]
         num_train = self.X_train.shape[0]
         # dists = np.zeros((num_test, num_train))
@@ -128,15 +260,19 @@ class KNearestNeighbor(object):
         #       and two broadcast sums.                                         #
         #########################################################################
         X_norms = np.sum(X ** 2, axis=1, keepdims=True)
-        X_train_norms = np.sum(self.X_train ** 2, axis=1)
-        cross = -2.0 * X.dot(self.X_train.T)
-        dists = np.sqrt(X_norms + cross + X_train_norms)
+        dists = X.dot(self.X_compute.T)
+        dists *= -2
+        dists += X_norms
+        dists += self.X_train_norms
+        np.maximum(dists, 0, out=dists)
+        if not squared:
+            dists = np.sqrt(dists, out=dists if dists.dtype.kind == 'f' else None)
         #########################################################################
         #                         END OF YOUR CODE                              #
         #########################################################################
         return dists
 
-    def predict_labels(self, dists, k=1):
+    def predict_labels(self, dists, k=1, return_neighbors=False):
         """
         Given a matrix of distances between test points and training points,
         predict a label for each test point.
@@ -144,40 +280,341 @@ class KNearestNeighbor(object):
         Inputs:
         - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
           gives the distance betwen the ith test point and the jth training point.
+        - k: The number of nearest neighbors that vote for the predicted labels.
+        - return_neighbors: If True, also return the neighbors that voted.
 
         Returns:
         - y: A numpy array of shape (num_test,) containing predicted labels for the
           test data, where y[i] is the predicted label for the test point X[i].
-        """
-        num_test = dists.shape[0]
-        y_pred = np.zeros(num_test)
-        for i in xrange(num_test):
-            # A list of length k storing the labels of the k nearest neighbors to
-            # the ith test point.
-            # closest_y = []
-            #########################################################################
-            # TODO:                                                                 #
-            # Use the distance matrix to find the k nearest neighbors of the ith    #
-            # testing point, and use self.y_train to find the labels of these       #
-            # neighbors. Store these labels in closest_y.                           #
-            # Hint: Look up the function numpy.argsort.                             #
-            #########################################################################
-            closest_y = np.argsort(dists[i, :])[:k]
-            
-            #########################################################################
-            # TODO:                                                                 #
-            # Now that you have found the labels of the k nearest neighbors, you    #
-            # need to find the most common label in the list closest_y of labels.   #
-            # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-            # label.                                                                #
-            #########################################################################
-            y_pred[i] = stats.mode(self.y_train[closest_y]).mode[0]
-            #########################################################################
-            #                           END OF YOUR CODE                            #
-            #########################################################################
 
+        If return_neighbors is True, instead return a tuple of:
+        - y: As above.
+        - neighbors: An integer array of shape (num_test, k) giving the indices
+          of the k nearest training points of each test point.
+        - neighbor_dists: A numpy array of shape (num_test, k) giving their
+          distances; see select_neighbors.
+        """
+        neighbor_dists, neighbors = self.select_neighbors(dists, k=k)
+        y_pred = self.vote_labels(neighbors)
+        if return_neighbors:
+            return y_pred, neighbors, neighbor_dists
         return y_pred
 
+    def select_neighbors(self, dists, k=1):
+        """
+        Find the k smallest entries of every row of a distance matrix with a
+        single argpartition over the whole block, without sorting full rows.
+
+        Inputs:
+        - dists: A numpy array of shape (num_test, num_train) of distances.
+        - k: The number of neighbors to select.
+
+        Returns a tuple of:
+        - neighbor_dists: A numpy array of shape (num_test, k) of the k smallest
+          distances in each row.
+        - neighbors: An integer array of shape (num_test, k) giving the training
+          indices of those distances. Each row is sorted by distance and then by
+          training index.
+        """
+        num_test, num_train = dists.shape
+        if not 1 <= k <= num_train:
+            raise ValueError('Invalid value %d for k with %d training points'
+                             % (k, num_train))
+        if k < num_train:
+            idx = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.tile(np.arange(num_train), (num_test, 1))
+        rows = np.arange(num_test)[:, np.newaxis]
+        return _merge_smallest(dists[rows, idx], idx, k)
+
+    def _block_sizes(self, num_test, num_train, itemsize):
+        """
+        Pick the shape of a distance tile so that the tile and the argpartition
+        indices computed from it fit in self.memory_budget bytes. Tiles are made
+        as wide as possible along the training set so that each test block
+        needs few passes over X_train.
+        """
+        tile_elems = max(1, int(self.memory_budget // (itemsize + 8)))
+        train_block = min(num_train, max(1, tile_elems // min(num_test, 256)))
+        test_block = min(num_test, max(1, tile_elems // train_block))
+        return test_block, train_block
+
+    def _block_shape_for(self, X):
+        """
+        Return the (test_block, train_block) tile shape used for test data X.
+        """
+        dtype = np.result_type(_distance_dtype(self.dtype, X.dtype),
+                               self.X_compute.dtype)
+        return self._block_sizes(X.shape[0], self.X_train.shape[0],
+                                 dtype.itemsize)
+
+    def iter_distance_blocks(self, X, block_shape=None):
+        """
+        Walk the test and training sets in blocks and yield squared L2
+        distances one tile at a time, so that the full (num_test, num_train)
+        matrix never has to exist.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - block_shape: Optional tuple (test_block, train_block) overriding the
+          tile shape derived from self.memory_budget.
+
+        Yields tuples (test_start, train_start, d2) where d2 is a numpy array
+        of shape (test_block, train_block) and d2[i, j] is the squared distance
+        between X[test_start + i] and self.X_train[train_start + j], computed
+        in self.dtype if it is set.
+        """
+        num_test = X.shape[0]
+        num_train = self.X_train.shape[0]
+        if block_shape is None:
+            block_shape = self._block_shape_for(X)
+        test_block, train_block = block_shape
+        for i0 in xrange(0, num_test, test_block):
+            X_block = X[i0:i0 + test_block]
+            X_block = X_block.astype(_distance_dtype(self.dtype, X.dtype),
+                                     copy=False)
+            X_norms = np.einsum('ij,ij->i', X_block, X_block)[:, np.newaxis]
+            for j0 in xrange(0, num_train, train_block):
+                d2 = X_block.dot(self.X_compute[j0:j0 + train_block].T)
+                d2 *= -2
+                d2 += X_norms
+                d2 += self.X_train_norms[j0:j0 + train_block]
+                # Cancellation in the expansion can give tiny negative values
+                np.maximum(d2, 0, out=d2)
+                yield i0, j0, d2
+
+    def compute_distances_blocked(self, X, squared=False):
+        """
+        Compute the full distance matrix with the blocked engine. This still
+        returns the (num_test, num_train) matrix, but the peak temporary memory
+        is bounded by self.memory_budget instead of a second full-size cross
+        term.
+
+        Input / Output: Same as compute_distances_no_loops
+        """
+        num_test = X.shape[0]
+        num_train = self.X_train.shape[0]
+        dtype = np.float64 if self.dtype is None else self.dtype
+        if not squared:
+            dtype = np.result_type(dtype, np.float32)
+        dists = np.empty((num_test, num_train), dtype=dtype)
+        for i0, j0, d2 in self.iter_distance_blocks(X):
+            out = dists[i0:i0 + d2.shape[0], j0:j0 + d2.shape[1]]
+            if squared:
+                out[...] = d2
+            else:
+                np.sqrt(d2, out=out)
+        return dists
+
+    def kneighbors(self, X, k=1, block_shape=None):
+        """
+        Find the k nearest training points for each test point. Distance tiles
+        from iter_distance_blocks are reduced to their k smallest entries and
+        merged into a running top-k as soon as they are produced.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of neighbors to find.
+        - block_shape: Optional tile shape; see iter_distance_blocks.
+
+        Returns a tuple of:
+        - dists: A numpy array of shape (num_test, k) where dists[i, j] is the
+          distance from X[i] to its (j+1)th nearest training point.
+        - neighbors: An integer array of shape (num_test, k) giving the indices
+          into self.X_train of those training points. Each row is sorted by
+          distance and then by training index.
+        """
+        num_test = X.shape[0]
+        num_train = self.X_train.shape[0]
+        if not 1 <= k <= num_train:
+            raise ValueError('Invalid value %d for k with %d training points'
+                             % (k, num_train))
+
+        best_d = np.empty((num_test, k))
+        best_d.fill(np.inf)
+        best_i = np.zeros((num_test, k), dtype=np.intp)
+        for i0, j0, d2 in self.iter_distance_blocks(X, block_shape):
+            rows = slice(i0, i0 + d2.shape[0])
+            if d2.shape[1] > k:
+                idx = np.argpartition(d2, k - 1, axis=1)[:, :k]
+                block_d = d2[np.arange(d2.shape[0])[:, np.newaxis], idx]
+            else:
+                idx = np.tile(np.arange(d2.shape[1]), (d2.shape[0], 1))
+                block_d = d2
+            best_d[rows], best_i[rows] = _merge_smallest(
+                np.hstack([best_d[rows], block_d]),
+                np.hstack([best_i[rows], idx + j0]), k)
+
+        return np.sqrt(best_d), best_i
+
+    def kneighbors_parallel(self, X, k=1, n_jobs=-1, backend='threads'):
+        """
+        Parallel version of kneighbors that shards the test set across a pool
+        of workers. Shards are aligned to the tiles that the serial engine
+        would use, so the results are identical to kneighbors(X, k).
+
+        With the 'threads' backend the workers read self.X_train directly; the
+        heavy numpy calls release the GIL. With the 'processes' backend the
+        training matrix is written once per call to a temporary .npy file that
+        every worker memory-maps read-only, so it is never pickled; the file
+        is removed once the pool has finished.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of neighbors to find.
+        - n_jobs: Number of workers; -1 uses every core.
+        - backend: Either 'threads' or 'processes'.
+
+        Returns: Same as kneighbors.
+        """
+        if n_jobs < 0:
+            n_jobs = multiprocessing.cpu_count()
+        block_shape = self._block_shape_for(X)
+        test_block = block_shape[0]
+        starts = np.arange(0, X.shape[0], test_block)
+        shards = [(chunk[0], min(chunk[-1] + test_block, X.shape[0]))
+                  for chunk in np.array_split(starts, n_jobs) if chunk.size]
+        jobs = [(X[a:b], k, block_shape) for a, b in shards]
+
+        if backend == 'threads':
+            pool = ThreadPool(len(jobs))
+            results = pool.map(lambda job: self.kneighbors(*job), jobs)
+            pool.close()
+            pool.join()
+        elif backend == 'processes':
+            shared_train = share_array(self.X_compute)
+            state = (shared_train, self.y_train, self.X_train_norms,
+                     self.memory_budget, self.dtype)
+            pool = multiprocessing.Pool(len(jobs), initializer=_init_worker,
+                                        initargs=state)
+            try:
+                results = pool.map(_kneighbors_worker, jobs)
+            finally:
+                pool.close()
+                pool.join()
+                release_shared_array(shared_train)
+        else:
+            raise ValueError('Invalid backend "%s"' % backend)
+
+        dists = np.concatenate([r[0] for r in results])
+        neighbors = np.concatenate([r[1] for r in results])
+        return dists, neighbors
+
+    def vote_labels(self, neighbors):
+        """
+        Predict a label for each test point by majority vote among its
+        neighbors, breaking ties by choosing the smaller label. All rows are
+        tallied at once with a single bincount over (row, label) keys.
+
+        Inputs:
+        - neighbors: An integer array of shape (num_test, k) of indices into
+          self.X_train, as returned by kneighbors or select_neighbors. Entries
+          of -1, which an approximate index uses for missing neighbors, do not
+          vote.
+
+        Returns:
+        - y: A numpy array of shape (num_test,) containing predicted labels.
+        """
+        num_test = neighbors.shape[0]
+        labels = self.y_train[neighbors]
+        keys = labels + self.num_classes * np.arange(num_test)[:, np.newaxis]
+        counts = np.bincount(keys.ravel(), weights=(neighbors >= 0).ravel(),
+                             minlength=num_test * self.num_classes)
+        # argmax returns the first maximum, which is the smallest tied label
+        return np.argmax(counts.reshape(num_test, self.num_classes), axis=1)
+
+
+def cross_validate_k(X, y, ks, num_folds=5, **kwargs):
+    """
+    Run k-fold cross-validation of KNearestNeighbor over a grid of k values.
+    Each fold costs a single distance pass through predict_multi_k, and the
+    squared norms of each fold are computed once and reused by every training
+    split that contains it.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) of training data.
+    - y: A numpy array of shape (N,) of training labels.
+    - ks: A list of the numbers of neighbors to try.
+    - num_folds: The number of folds to split the data into.
+    - kwargs: Extra keyword arguments passed to the KNearestNeighbor
+      constructor, such as memory_budget.
+
+    Returns:
+    A dictionary mapping each k in ks to a list of length num_folds giving the
+    validation accuracy on each fold.
+    """
+    X_folds = np.array_split(X, num_folds)
+    y_folds = np.array_split(y, num_folds)
+    norm_folds = [_squared_norms(X_fold, kwargs.get('dtype'))
+                  for X_fold in X_folds]
+
+    k_to_accuracies = dict((k, []) for k in ks)
+    for i in xrange(num_folds):
+        others = [j for j in xrange(num_folds) if j != i]
+        classifier = KNearestNeighbor(**kwargs)
+        classifier.train(np.concatenate([X_folds[j] for j in others]),
+                         np.concatenate([y_folds[j] for j in others]),
+                         X_norms=np.concatenate([norm_folds[j] for j in others]))
+        y_preds = classifier.predict_multi_k(X_folds[i], ks)
+        for k in ks:
+            k_to_accuracies[k].append(np.mean(y_preds[k] == y_folds[i]))
+    return k_to_accuracies
+
+
+def compare_precision(X_train, y_train, X, k=10, dtype=np.float32):
+    """
+    Report how much the neighbors found in a reduced precision differ from a
+    float64 reference.
+
+    Inputs:
+    - X_train: A numpy array of shape (num_train, D) of training data.
+    - y_train: A numpy array of shape (num_train,) of training labels.
+    - X: A numpy array of shape (num_test, D) of test data.
+    - k: The number of neighbors to compare.
+    - dtype: The dtype to compare against float64, such as np.float32 or
+      np.int32 for uint8 pixels.
+
+    Returns:
+    A dictionary with the following keys:
+    - 'same_neighbors': Fraction of test points whose k neighbors are exactly
+      the same set as in the reference.
+    - 'overlap': Average fraction of the reference neighbors that were found.
+    - 'same_predictions': Fraction of test points whose majority vote over the
+      k neighbors is unchanged.
+    - 'max_rel_error': Largest relative error of the k neighbor distances.
+    """
+    reference = KNearestNeighbor(dtype=np.float64)
+    reference.train(X_train, y_train)
+    ref_dists, ref_neighbors = reference.kneighbors(X, k=k)
+    reduced = KNearestNeighbor(dtype=dtype)
+    reduced.train(X_train, y_train)
+    dists, neighbors = reduced.kneighbors(X, k=k)
+
+    num_test = X.shape[0]
+    overlap = np.array([np.intersect1d(ref_neighbors[i], neighbors[i]).size
+                        for i in xrange(num_test)])
+    scale = np.maximum(ref_dists, np.finfo(np.float64).tiny)
+    return {
+        'same_neighbors': np.mean(overlap == k),
+        'overlap': np.mean(overlap) / k,
+        'same_predictions': np.mean(reference.vote_labels(ref_neighbors) ==
+                                    reference.vote_labels(neighbors)),
+        'max_rel_error': np.max(np.abs(dists - ref_dists) / scale),
+    }
+
+
+# Classifier used by the workers of KNearestNeighbor.kneighbors_parallel when
+# running with the 'processes' backend; set once per worker by _init_worker.
+_worker_classifier = None
+
 
+def _init_worker(shared_train, y, X_norms, memory_budget, dtype):
+    global _worker_classifier
+    X = open_shared_array(shared_train)
+    _worker_classifier = KNearestNeighbor(memory_budget=memory_budget,
+                                          dtype=dtype)
+    _worker_classifier.train(X, y, X_norms=X_norms)
 
 
+def _kneighbors_worker(job):
+    return _worker_classifier.kneighbors(*job)
@@ -1,4 +1,5 @@
 import numpy as np
+from cs231n.minibatch import MinibatchIterator
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
 
@@ -8,7 +9,7 @@ class LinearClassifier(object):
     self.W = None
 
   def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, prefetch=False, seed=None):
     """
     Train this linear classifier using stochastic gradient descent.
 
@@ -22,18 +23,25 @@ class LinearClassifier(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - prefetch: (boolean) If true, gather minibatches in a background thread.
+    - seed: Optional seed for the initial weights and the minibatches; if None
+      the global numpy random state is used.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
     """
     num_train, dim = X.shape
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
+    rng = np.random if seed is None else np.random.RandomState(seed)
     if self.W is None:
       # lazily initialize W
-      self.W = 0.001 * np.random.randn(dim, num_classes)
+      self.W = 0.001 * rng.randn(dim, num_classes)
+    batch_seed = None if seed is None else rng.randint(2 ** 31 - 1)
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
+    batches = MinibatchIterator(X, y, batch_size, prefetch=prefetch,
+                                seed=batch_seed)
     for it in xrange(num_iters):
       X_batch = None
       y_batch = None
@@ -49,9 +57,7 @@ class LinearClassifier(object):
       # Hint: Use np.random.choice to generate indices. Sampling with         #
       # replacement is faster than sampling without replacement.              #
       #########################################################################
-      batch_idx = np.random.choice(range(num_train), batch_size, replace=True)
-      X_batch = X[batch_idx]
-      y_batch = y[batch_idx]
+      X_batch, y_batch = batches.next()
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
@@ -65,7 +71,6 @@ class LinearClassifier(object):
       # TODO:                                                                 #
       # Update the weights using the gradient and the learning rate.          #
       #########################################################################
-      loss, grad = self.loss(X_batch, y_batch, reg)
       self.W -= learning_rate * grad
       #########################################################################
       #                       END OF YOUR CODE                                #
@@ -74,6 +79,7 @@ class LinearClassifier(object):
       if verbose and it % 100 == 0:
         print 'iteration %d / %d: loss %f' % (it, num_iters, loss)
 
+    batches.close()
     return loss_history
 
   def predict(self, X):
@@ -118,10 +124,63 @@ class LinearClassifier(object):
     """
     pass
 
+  # Loss function with the signature of svm_loss_stacked used by
+  # train_stacked; subclasses set this.
+  stacked_loss = None
+
+  @classmethod
+  def train_stacked(cls, X, y, learning_rates, regs, num_iters=100,
+                    batch_size=200, verbose=False, prefetch=False):
+    """
+    Train K models of this class at once, one per pair of learning rate and
+    regularization strength. The K weight matrices are stacked into a single
+    (D, K * C) matrix so that each minibatch costs one matrix multiply for all
+    models, and every model sees the same sequence of minibatches.
+
+    Inputs:
+    - X, y, num_iters, batch_size, verbose, prefetch: Same as train.
+    - learning_rates: A list of K learning rates.
+    - regs: A list of K regularization strengths; model i is trained with
+      learning_rates[i] and regs[i].
+
+    Returns a tuple of:
+    - models: A list of K instances of this class holding the trained weights.
+    - loss_history: A numpy array of shape (num_iters, K) giving the loss of
+      every model at each iteration.
+    """
+    learning_rates = np.asarray(learning_rates, dtype=float)
+    regs = np.asarray(regs, dtype=float)
+    K = len(learning_rates)
+    dim = X.shape[1]
+    num_classes = np.max(y) + 1
+    W = 0.001 * np.random.randn(dim, K, num_classes)
+
+    loss_history = np.zeros((num_iters, K))
+    batches = MinibatchIterator(X, y, batch_size, prefetch=prefetch)
+    for it in xrange(num_iters):
+      X_batch, y_batch = batches.next()
+      loss, grad = cls.stacked_loss(W, X_batch, y_batch, regs)
+      loss_history[it] = loss
+      grad *= learning_rates[:, np.newaxis]
+      W -= grad
+
+      if verbose and it % 100 == 0:
+        print 'iteration %d / %d: best loss %f' % (it, num_iters, np.min(loss))
+    batches.close()
+
+    models = []
+    for k in xrange(K):
+      model = cls()
+      model.W = W[:, k, :].copy()
+      models.append(model)
+    return models, loss_history
+
 
 class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
 
+  stacked_loss = staticmethod(svm_loss_stacked)
+
   def loss(self, X_batch, y_batch, reg):
     return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
 
@@ -129,6 +188,7 @@ class LinearSVM(LinearClassifier):
 class Softmax(LinearClassifier):
   """ A subclass that uses the Softmax + Cross-entropy loss function """
 
+  stacked_loss = staticmethod(softmax_loss_stacked)
+
   def loss(self, X_batch, y_batch, reg):
     return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
-
@@ -1,5 +1,7 @@
+import time
 import numpy as np
 from random import shuffle
+from cs231n.classifiers.softmax import softmax_loss_naive, softmax_loss_vectorized
 
 
 def svm_loss_naive(W, X, y, reg):
@@ -71,28 +73,29 @@ def svm_loss_vectorized(W, X, y, reg):
     Structured SVM loss function, vectorized implementation.
   
     Inputs and outputs are the same as svm_loss_naive.
+
+    The margins are computed once into the scores buffer, which is then reused
+    in place as the coefficient matrix of the gradient. Everything is computed
+    in the dtype of W and X, so float32 inputs give float32 gradients.
     """
-    loss = 0.0
-    dW = np.zeros(W.shape)  # initialize the gradient as zero
     delta = 1
     #############################################################################
     # TODO:                                                                     #
     # Implement a vectorized version of the structured SVM loss, storing the    #
     # result in loss.                                                           #
     #############################################################################
-    num_classes = W.shape[1]
     num_train = X.shape[0]
-    S = X.dot(W)
-    y_pos = [yi * num_classes + yv for yi, yv in enumerate(y)]
-    correct_S = S.reshape(num_classes * num_train)[y_pos].reshape([num_train, 1])
-    loss = sum(sum(np.maximum(S - correct_S + delta, 0))) - num_train  # because Syi - Syi we over calculated always equal to 0, so the loss would always be 1
-
-    # Right now the loss is a sum over all training examples, but we want it
-    # to be an average instead so we divide by num_train.
-    loss /= num_train
+    rows = np.arange(num_train)
+    margins = X.dot(W)
+    correct_scores = margins[rows, y]
+    margins -= correct_scores[:, np.newaxis]
+    margins += delta
+    margins[rows, y] = 0
+    np.maximum(margins, 0, out=margins)
+    loss = margins.sum() / num_train
 
     # Add regularization to the loss.
-    loss += 0.5 * reg * np.sum(W * W)
+    loss += 0.5 * reg * np.vdot(W, W)
     #############################################################################
     #                             END OF YOUR CODE                              #
     #############################################################################
@@ -107,17 +110,124 @@ def svm_loss_vectorized(W, X, y, reg):
     # to reuse some of the intermediate values that you used to compute the     #
     # loss.                                                                     #
     #############################################################################
+    # Every positive margin contributes +X[i] to its class and -X[i] to the
+    # correct class; margins are non-negative, so sign gives the 0/1 mask.
+    np.sign(margins, out=margins)
+    margins[rows, y] = -margins.sum(axis=1)
+    dW = X.T.dot(margins)
+    dW /= num_train
+
+    # Add regularization to the gradient.
+    dW += reg * W
+    #############################################################################
+    #                             END OF YOUR CODE                              #
+    #############################################################################
+
+    return loss, dW
+
+
+def svm_loss_stacked(W, X, y, reg):
+    """
+    Structured SVM loss for K models at once that share one minibatch. The
+    weights of all models are multiplied with X in a single matrix multiply
+    and the losses and gradients are reduced separately for each model.
+
+    Inputs:
+    - W: A numpy array of shape (D, K, C) containing the weights of K models.
+    - X: A numpy array of shape (N, D) containing a minibatch of data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - reg: A numpy array of shape (K,) of regularization strengths.
+
+    Returns a tuple of:
+    - loss: A numpy array of shape (K,) giving the loss of each model.
+    - dW: Gradient with respect to W; an array of the same shape as W.
+    """
+    D, K, C = W.shape
+    num_train = X.shape[0]
+    rows = np.arange(num_train)
+    margins = X.dot(W.reshape(D, K * C)).reshape(num_train, K, C)
+    correct_scores = margins[rows, :, y]
+    margins -= correct_scores[:, :, np.newaxis]
+    margins += 1
+    margins[rows, :, y] = 0
+    np.maximum(margins, 0, out=margins)
+    loss = margins.sum(axis=(0, 2)) / num_train
+    loss += 0.5 * reg * np.einsum('dkc,dkc->k', W, W)
+
+    np.sign(margins, out=margins)
+    margins[rows, :, y] = -margins.sum(axis=2)
+    dW = X.T.dot(margins.reshape(num_train, K * C)).reshape(D, K, C)
+    dW /= num_train
+    dW += reg[:, np.newaxis] * W
+    return loss, dW
+
+
+def svm_loss_reference(W, X, y, reg):
+    """
+    The earlier vectorized SVM loss, which builds the margins with Python index
+    lists and a separate integer mask for the gradient. It is kept only as a
+    baseline for benchmark_loss; use svm_loss_vectorized instead.
+    """
+    delta = 1
+    num_classes = W.shape[1]
+    num_train = X.shape[0]
+    S = X.dot(W)
+    y_pos = [yi * num_classes + yv for yi, yv in enumerate(y)]
+    correct_S = S.reshape(num_classes * num_train)[y_pos].reshape([num_train, 1])
+    loss = sum(sum(np.maximum(S - correct_S + delta, 0))) - num_train
+    loss /= num_train
+    loss += 0.5 * reg * np.sum(W * W)
+
     dW_correct_vec = -(np.sum(S - correct_S + delta > 0, 1) - 1)
     dW_mat = (S - correct_S + delta > 0).reshape(num_train * num_classes).astype(int)
     dW_mat[y_pos] = dW_correct_vec
     dW = X.T.dot(dW_mat.reshape([num_train, num_classes]))
     dW /= num_train
-
-    # Add regularization to the loss.
     dW += 0.5 * reg * 2 * W
+    return loss, dW
 
-    #############################################################################
-    #                             END OF YOUR CODE                              #
-    #############################################################################
 
-    return loss, dW
+def benchmark_loss(loss_fns=None, sizes=(500, 5000, 50000), dim=3073,
+                   num_classes=10, dtype=np.float64, num_repeats=3,
+                   verbose=True):
+    """
+    Time loss functions on random data of increasing minibatch size.
+
+    Inputs:
+    - loss_fns: Dictionary mapping names to loss functions with the signature
+      of svm_loss_naive. Defaults to the vectorized SVM and softmax losses
+      and two references to compare them against: softmax_loss_naive, which
+      is itself loop-free, and svm_loss_reference, the earlier vectorized SVM
+      loss.
+    - sizes: Minibatch sizes N to try.
+    - dim: Data dimension D; the default matches CIFAR-10 with a bias column.
+    - num_classes: Number of classes C.
+    - dtype: Numpy datatype of the data and weights.
+    - num_repeats: The best time over this many calls is reported.
+    - verbose: Boolean; if true, print one line per loss function and size.
+
+    Returns:
+    A dictionary mapping (name, N) to the best time in seconds.
+    """
+    if loss_fns is None:
+        loss_fns = {
+            'svm_loss_reference': svm_loss_reference,
+            'svm_loss_vectorized': svm_loss_vectorized,
+            'softmax_loss_naive': softmax_loss_naive,
+            'softmax_loss_vectorized': softmax_loss_vectorized,
+        }
+    timings = {}
+    W = (0.001 * np.random.randn(dim, num_classes)).astype(dtype)
+    for N in sizes:
+        X = np.random.randn(N, dim).astype(dtype)
+        y = np.random.randint(num_classes, size=N)
+        for name in sorted(loss_fns):
+            best = np.inf
+            for _ in xrange(num_repeats):
+                tic = time.time()
+                loss_fns[name](W, X, y, 1e-5)
+                best = min(best, time.time() - tic)
+            timings[name, N] = best
+            if verbose:
+                print '%-24s N=%-6d %.4f s' % (name, N, best)
+    return timings
@@ -87,21 +87,67 @@ def softmax_loss_vectorized(W, X, y, reg):
     Softmax loss function, vectorized version.
 
     Inputs and outputs are the same as softmax_loss_naive.
-    """
-    # Initialize the loss and gradient to zero.
-    loss = 0.0
-    dW = np.zeros_like(W)
 
+    The scores are shifted by their row maximum for numerical stability and
+    exponentiated once in place; the same buffer then holds the probabilities
+    and the gradient with respect to the scores. Everything is computed in the
+    dtype of W and X, so float32 inputs give float32 gradients.
+    """
     #############################################################################
     # TODO: Compute the softmax loss and its gradient using no explicit loops.  #
     # Store the loss in loss and the gradient in dW. If you are not careful     #
     # here, it is easy to run into numeric instability. Don't forget the        #
     # regularization!                                                           #
     #############################################################################
-    pass
+    num_train = X.shape[0]
+    rows = np.arange(num_train)
+    probs = X.dot(W)
+    probs -= probs.max(axis=1, keepdims=True)
+    correct_scores = probs[rows, y]
+    np.exp(probs, out=probs)
+    sums = probs.sum(axis=1, keepdims=True)
+    probs /= sums
+
+    # log(sum_j exp(s_j)) - s_y, evaluated on the shifted scores so that it
+    # stays finite even when the probability of the correct class underflows
+    loss = (np.sum(np.log(sums)) - np.sum(correct_scores)) / num_train
+    loss += 0.5 * reg * np.vdot(W, W)
+
+    probs[rows, y] -= 1
+    dW = X.T.dot(probs)
+    dW /= num_train
+    dW += reg * W
     #############################################################################
     #                          END OF YOUR CODE                                 #
     #############################################################################
 
-    return softmax_loss_naive(W, X, y, reg)
-    # return loss, dW
+    return loss, dW
+
+
+def softmax_loss_stacked(W, X, y, reg):
+    """
+    Softmax loss for K models at once that share one minibatch. The weights of
+    all models are multiplied with X in a single matrix multiply and the
+    losses and gradients are reduced separately for each model.
+
+    Inputs and outputs are the same as svm_loss_stacked.
+    """
+    D, K, C = W.shape
+    num_train = X.shape[0]
+    rows = np.arange(num_train)
+    probs = X.dot(W.reshape(D, K * C)).reshape(num_train, K, C)
+    probs -= probs.max(axis=2, keepdims=True)
+    correct_scores = probs[rows, :, y]
+    np.exp(probs, out=probs)
+    sums = probs.sum(axis=2, keepdims=True)
+    probs /= sums
+
+    loss = (np.log(sums[:, :, 0]).sum(axis=0) - correct_scores.sum(axis=0))
+    loss /= num_train
+    loss += 0.5 * reg * np.einsum('dkc,dkc->k', W, W)
+
+    probs[rows, :, y] -= 1
+    dW = X.T.dot(probs.reshape(num_train, K * C)).reshape(D, K, C)
+    dW /= num_train
+    dW += reg[:, np.newaxis] * W
+    return loss, dW
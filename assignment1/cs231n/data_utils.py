@@ -1,4 +1,5 @@
 import cPickle as pickle
+import json
 import numpy as np
 import os
 from scipy.misc import imread
@@ -147,6 +148,10 @@ def load_models(models_dir):
 
   Returns:
   A dictionary mapping model file names to models.
+
+  This loads every model into memory; to pick one model out of a directory of
+  large checkpoints, convert the directory once with ModelStore.import_pickled
+  and use the ModelStore instead.
   """
   models = {}
   for model_file in os.listdir(models_dir):
@@ -156,3 +161,176 @@ def load_models(models_dir):
       except pickle.UnpicklingError:
         continue
   return models
+
+
+class ModelStore(object):
+  """
+  A directory of saved models that can be listed and searched without loading
+  any parameters. Each model is stored as a subdirectory holding one
+  uncompressed .npy file per parameter, and a JSON index in the root records
+  for every model its architecture, validation accuracy, parameter shapes and
+  size, along with any other metadata given when it was saved.
+
+  Loading a model memory-maps its parameter files, so only the parameters
+  that are actually read are brought into memory.
+
+  Example usage:
+
+  store = ModelStore('cs231n/models')
+  store.import_pickled('old_models')  # one-time conversion
+  name = store.best('val_acc')
+  model = store[name]
+  """
+
+  def __init__(self, root):
+    """
+    Inputs:
+    - root: String giving the path to the store directory; it is created if
+      it does not exist.
+    """
+    self.root = root
+    self.index_path = os.path.join(root, 'index.json')
+    if not os.path.isdir(root):
+      os.makedirs(root)
+    self.index = {}
+    if os.path.exists(self.index_path):
+      with open(self.index_path, 'r') as f:
+        self.index = json.load(f)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, name):
+    return name in self.index
+
+  def __getitem__(self, name):
+    return self.load(name)
+
+  def names(self):
+    """
+    Return a sorted list of the names of the stored models.
+    """
+    return sorted(self.index)
+
+  def metadata(self, name):
+    """
+    Return the metadata dictionary of a stored model, with keys 'name',
+    'architecture', 'val_acc', 'shapes', 'dtypes', 'num_params' and 'nbytes'
+    plus any extra metadata given to save.
+    """
+    return self.index[name]
+
+  def best(self, key='val_acc'):
+    """
+    Return the name of the model with the largest value of a metadata key,
+    ignoring models that do not have it.
+    """
+    candidates = [name for name in self.index
+                  if self.index[name].get(key) is not None]
+    if not candidates:
+      raise KeyError('No stored model has metadata "%s"' % key)
+    return max(candidates, key=lambda name: self.index[name][key])
+
+  def save(self, name, model, architecture=None, val_acc=None, **metadata):
+    """
+    Store a model, replacing any stored model with the same name.
+
+    Inputs:
+    - name: String naming the model; used as a directory name.
+    - model: Dictionary mapping parameter names to numpy arrays.
+    - architecture: Optional string describing the architecture.
+    - val_acc: Optional validation accuracy.
+    - metadata: Any other JSON-serializable metadata to keep in the index.
+    """
+    if not name or os.sep in name or name.startswith('.'):
+      raise ValueError('Invalid model name "%s"' % name)
+    model_dir = os.path.join(self.root, name)
+    if not os.path.isdir(model_dir):
+      os.makedirs(model_dir)
+    for param_file in os.listdir(model_dir):
+      os.remove(os.path.join(model_dir, param_file))
+    params = dict((k, np.asarray(v)) for k, v in model.iteritems())
+    for k, v in params.iteritems():
+      np.save(os.path.join(model_dir, '%s.npy' % k), v)
+
+    entry = dict(metadata)
+    entry.update({
+      'name': name,
+      'architecture': architecture,
+      'val_acc': None if val_acc is None else float(val_acc),
+      'shapes': dict((k, list(v.shape)) for k, v in params.iteritems()),
+      'dtypes': dict((k, v.dtype.str) for k, v in params.iteritems()),
+      'num_params': sum(int(v.size) for v in params.itervalues()),
+      'nbytes': sum(int(v.nbytes) for v in params.itervalues()),
+    })
+    self.index[name] = entry
+    self._write_index()
+
+  def load(self, name, mmap_mode='r'):
+    """
+    Load the parameters of a stored model.
+
+    Inputs:
+    - name: Name of the model.
+    - mmap_mode: Passed to np.load; the default memory-maps the parameters
+      read-only. Use None to read them into memory, or 'c' for writable
+      copy-on-write arrays.
+
+    Returns:
+    A dictionary mapping parameter names to arrays.
+    """
+    if name not in self.index:
+      raise KeyError('No stored model named "%s"' % name)
+    model_dir = os.path.join(self.root, name)
+    return dict((k, np.load(os.path.join(model_dir, '%s.npy' % k),
+                            mmap_mode=mmap_mode))
+                for k in self.index[name]['shapes'])
+
+  def remove(self, name):
+    """
+    Delete a stored model.
+    """
+    model_dir = os.path.join(self.root, name)
+    for k in self.index[name]['shapes']:
+      os.remove(os.path.join(model_dir, '%s.npy' % k))
+    os.rmdir(model_dir)
+    del self.index[name]
+    self._write_index()
+
+  def import_pickled(self, models_dir):
+    """
+    Add the models in a directory of pickled model files, as read by
+    load_models, to the store. Scalar and string entries of each pickled
+    dictionary other than 'model' become metadata. Files that cannot be
+    unpickled are skipped.
+
+    Inputs:
+    - models_dir: String giving the path to a directory of model files.
+
+    Returns:
+    A list of the names of the imported models.
+    """
+    imported = []
+    for model_file in sorted(os.listdir(models_dir)):
+      path = os.path.join(models_dir, model_file)
+      if not os.path.isfile(path):
+        continue
+      with open(path, 'rb') as f:
+        try:
+          checkpoint = pickle.load(f)
+        except Exception:
+          continue
+      if not isinstance(checkpoint, dict) or 'model' not in checkpoint:
+        continue
+      metadata = dict((k, v) for k, v in checkpoint.iteritems()
+                      if k != 'model' and isinstance(v, (int, long, float, str)))
+      self.save(model_file, checkpoint['model'], **metadata)
+      imported.append(model_file)
+    return imported
+
+  def _write_index(self):
+    # Write to a temporary file first so a crash never leaves a broken index
+    tmp_path = self.index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.index, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, self.index_path)
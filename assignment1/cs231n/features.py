@@ -1,3 +1,8 @@
+import functools
+import hashlib
+import multiprocessing
+import os
+import tempfile
 import matplotlib
 import numpy as np
 from scipy.ndimage import uniform_filter
@@ -53,6 +58,189 @@ def extract_features(imgs, feature_fns, verbose=False):
   return imgs_features
 
 
+def extract_features_cached(imgs, feature_fns, cache_dir=None, chunk_size=1000,
+                            n_jobs=-1, verbose=False):
+  """
+  Same as extract_features, but the images are processed in chunks by a pool
+  of worker processes that write their rows straight into a memory-mapped
+  .npy file, so the full feature matrix never has to be held in memory.
+
+  If cache_dir is None the file is temporary and is removed as soon as the
+  result has been mapped. If cache_dir is given, the file is named by a hash
+  of the images and the feature functions, and a later call with the same
+  inputs loads it from disk instead of recomputing it. This makes re-running a notebook, or extracting
+  the train, val and test splits again, nearly free.
+
+  Feature functions that have a batched version (hog_feature and
+  color_histogram_hsv, also through functools.partial) are applied to a whole
+  chunk at once; any other function is applied image by image.
+
+  The worker processes are forked and inherit the images and the feature
+  functions, so lambdas work as feature functions and nothing is pickled.
+
+  Inputs:
+  - imgs: N x H X W X C array of pixel data for N images.
+  - feature_fns: List of k feature functions, as for extract_features.
+  - cache_dir: Optional directory for cached features.
+  - chunk_size: Number of images given to a worker at a time.
+  - n_jobs: Number of worker processes; -1 uses every core and 1 works in the
+    current process.
+  - verbose: Boolean; if true, print progress.
+
+  Returns:
+  An array of shape (N, F_1 + ... + F_k), memory-mapped copy-on-write from
+  the output file, so in-place changes such as mean subtraction do not
+  modify the cache.
+  """
+  global _worker_state
+  num_images = imgs.shape[0]
+  if num_images == 0:
+    return np.array([])
+
+  # Use the first image to determine feature dimensions
+  feature_dims = []
+  for feature_fn in feature_fns:
+    feats = feature_fn(imgs[0].squeeze())
+    assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
+    feature_dims.append(feats.size)
+
+  if cache_dir is None:
+    # Write to an anonymous temporary file and unlink it once the result is
+    # mapped; the mapping keeps the data alive until the array is freed.
+    fd, partial_path = tempfile.mkstemp(suffix='.npy')
+    os.close(fd)
+    path = None
+  else:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, _features_key(imgs, feature_fns) + '.npy')
+    if os.path.exists(path):
+      if verbose:
+        print 'Loaded cached features from %s' % path
+      return np.load(path, mmap_mode='c')
+    # Write to a temporary name so that an interrupted run is never mistaken
+    # for a complete cache entry.
+    partial_path = path + '.partial'
+
+  pool = None
+  try:
+    out = np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.float64,
+                                    shape=(num_images, sum(feature_dims)))
+    del out
+
+    _worker_state = (imgs, feature_fns, feature_dims, partial_path)
+    starts = range(0, num_images, chunk_size)
+    chunks = [(start, min(start + chunk_size, num_images)) for start in starts]
+    if n_jobs < 0:
+      n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1:
+      done_chunks = (_extract_chunk(chunk) for chunk in chunks)
+    else:
+      pool = multiprocessing.Pool(n_jobs)
+      done_chunks = pool.imap_unordered(_extract_chunk, chunks)
+
+    num_done = 0
+    for count in done_chunks:
+      num_done += count
+      if verbose:
+        print 'Done extracting features for %d / %d images' % (num_done,
+                                                               num_images)
+
+    if path is None:
+      return np.load(partial_path, mmap_mode='c')
+    os.rename(partial_path, path)
+    return np.load(path, mmap_mode='c')
+  finally:
+    # Every chunk has been written by now unless there was an error, in which
+    # case the remaining work is abandoned.
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+    _worker_state = None
+    _remove_file(partial_path)
+
+
+# State shared with the forked workers of extract_features_cached; a tuple
+# (imgs, feature_fns, feature_dims, output path).
+_worker_state = None
+
+
+def _extract_chunk(chunk):
+  """
+  Compute the features of images start:stop and write them to the output
+  file; returns the number of images processed.
+  """
+  start, stop = chunk
+  imgs, feature_fns, feature_dims, path = _worker_state
+  out = np.load(path, mmap_mode='r+')
+  idx = 0
+  for feature_fn, feature_dim in zip(feature_fns, feature_dims):
+    next_idx = idx + feature_dim
+    batch_fn = _batch_version(feature_fn)
+    if batch_fn is not None:
+      out[start:stop, idx:next_idx] = batch_fn(imgs[start:stop])
+    else:
+      for i in xrange(start, stop):
+        out[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
+    idx = next_idx
+  out.flush()
+  del out
+  return stop - start
+
+
+def _remove_file(filename):
+  if os.path.exists(filename):
+    os.remove(filename)
+
+
+def _batch_version(feature_fn):
+  """
+  Return a function computing feature_fn for a whole batch of images, or None
+  if there is no batched version.
+  """
+  if isinstance(feature_fn, functools.partial) and not feature_fn.args:
+    batch_fn = _batch_version(feature_fn.func)
+    if batch_fn is not None:
+      return functools.partial(batch_fn, **(feature_fn.keywords or {}))
+    return None
+  return _BATCH_VERSIONS.get(feature_fn)
+
+
+def _features_key(imgs, feature_fns):
+  """
+  Hash the contents of imgs and a description of each feature function.
+  """
+  h = hashlib.sha1()
+  h.update(repr((imgs.shape, imgs.dtype.str)))
+  rows_per_chunk = max(1, 2 ** 24 // max(1, imgs[0].nbytes))
+  for i0 in xrange(0, imgs.shape[0], rows_per_chunk):
+    h.update(np.ascontiguousarray(imgs[i0:i0 + rows_per_chunk]).data)
+  for feature_fn in feature_fns:
+    h.update(_function_key(feature_fn))
+  return h.hexdigest()
+
+
+def _function_key(fn):
+  """
+  Describe a feature function by its name, bytecode, constants, default
+  arguments and the values of closure variables and simple globals it uses,
+  so that for example changing the number of bins of a lambda changes the
+  key.
+  """
+  if isinstance(fn, functools.partial):
+    return 'partial(%s, %r, %r)' % (_function_key(fn.func), fn.args,
+                                    sorted((fn.keywords or {}).items()))
+  code = getattr(fn, '__code__', None)
+  if code is None:
+    return repr(fn)
+  closure = [cell.cell_contents for cell in (fn.__closure__ or ())]
+  simple_globals = [(name, fn.__globals__[name]) for name in code.co_names
+                    if isinstance(fn.__globals__.get(name),
+                                  (int, long, float, str, tuple))]
+  return repr((fn.__module__, fn.__name__, code.co_code, code.co_consts,
+               fn.__defaults__, closure, simple_globals))
+
+
 def rgb2gray(rgb):
   """Convert RGB image to grayscale
 
@@ -120,6 +308,77 @@ def hog_feature(im):
   return orientation_histogram.ravel()
 
 
+def hog_feature_batch(imgs, chunk_size=1000):
+  """Compute HOG features for a batch of images at once
+
+    Computes the same features as hog_feature for every image, but does the
+    gradients, orientation binning and cell pooling for a whole chunk of
+    images with array operations. Instead of one uniform_filter per
+    orientation bin, the gradient magnitudes are summed into (image, cell,
+    bin) slots with a single bincount.
+
+    Parameters:
+      imgs : N x H x W x C array of rgb images, or N x H x W array of
+        grayscale images
+      chunk_size : number of images processed at a time, which bounds the
+        size of the temporary arrays
+
+    Returns:
+      feats: N x F array; feats[i] equals hog_feature(imgs[i])
+  """
+  orientations = 9 # number of gradient bins
+  cx, cy = (8, 8) # pixels per cell
+  bin_width = 180 / orientations
+
+  num_images = imgs.shape[0]
+  sx, sy = imgs.shape[1:3] # image size
+  n_cellsx = int(np.floor(sx / cx))  # number of cells in x
+  n_cellsy = int(np.floor(sy / cy))  # number of cells in y
+  num_slots = n_cellsx * n_cellsy * orientations
+
+  # Cell index of every pixel that lies inside a whole cell; pixels of a
+  # partial cell at the border are dropped, as in hog_feature.
+  cell_rows = np.arange(n_cellsx * cx) // cx
+  cell_cols = np.arange(n_cellsy * cy) // cy
+  cell_idx = (cell_rows[:, np.newaxis] * n_cellsy + cell_cols) * orientations
+
+  feats = np.zeros((num_images, num_slots))
+  for i0 in xrange(0, num_images, chunk_size):
+    chunk = imgs[i0:i0 + chunk_size]
+    if chunk.ndim == 4:
+      image = rgb2gray(chunk)
+    else:
+      image = chunk.astype(np.float64)
+    n = image.shape[0]
+
+    gx = np.zeros(image.shape)
+    gy = np.zeros(image.shape)
+    gx[:, :, :-1] = np.diff(image, n=1, axis=2) # gradient on x-direction
+    gy[:, :-1, :] = np.diff(image, n=1, axis=1) # gradient on y-direction
+    grad_mag = np.sqrt(gx ** 2 + gy ** 2)
+    grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90
+    grad_mag = grad_mag[:, :n_cellsx * cx, :n_cellsy * cy]
+    grad_ori = grad_ori[:, :n_cellsx * cx, :n_cellsy * cy]
+
+    # Orientation bin of every pixel, with the same boundary tests as
+    # hog_feature; orientations of exactly 0 or 180 fall in no bin.
+    bins = np.floor(grad_ori / bin_width).astype(np.intp)
+    bins -= grad_ori < bin_width * bins
+    bins += grad_ori >= bin_width * (bins + 1)
+    weights = np.where((grad_ori > 0) & (bins < orientations), grad_mag, 0)
+    np.clip(bins, 0, orientations - 1, out=bins)
+
+    keys = bins + cell_idx
+    keys += (num_slots * np.arange(n))[:, np.newaxis, np.newaxis]
+    sums = np.bincount(keys.ravel(), weights=weights.ravel(),
+                       minlength=n * num_slots)
+    # hog_feature averages each cell and stores the cells transposed
+    hist = sums.reshape(n, n_cellsx, n_cellsy, orientations) / (cx * cy)
+    feats[i0:i0 + n] = hist.transpose(0, 2, 1, 3).reshape(n, -1)
+
+  return feats
+
+
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   """
   Compute color histogram for an image using hue.
@@ -146,3 +405,80 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
 
 
 pass
+
+
+def color_histogram_hsv_batch(imgs, nbin=10, xmin=0, xmax=255,
+                              normalized=True, chunk_size=1000):
+  """
+  Compute hue color histograms for a batch of images at once.
+
+  The hue of every pixel in a chunk of images is computed in one vectorized
+  pass, with the same arithmetic as matplotlib.colors.rgb_to_hsv, and all
+  histograms of the chunk are built with a single bincount over (image, bin)
+  keys.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for RGB images. uint8 input is
+    accepted directly; only one chunk at a time is scaled to floating point,
+    so the full dataset is never converted.
+  - nbin, xmin, xmax, normalized: Same as color_histogram_hsv.
+  - chunk_size: Number of images processed at a time.
+
+  Returns:
+    N x nbin array; row i is the color histogram of imgs[i], computed as by
+    color_histogram_hsv on the float image.
+  """
+  num_images = imgs.shape[0]
+  bins = np.linspace(xmin, xmax, nbin+1)
+  bin_widths = np.diff(bins)
+  hists = np.zeros((num_images, nbin))
+  for i0 in xrange(0, num_images, chunk_size):
+    chunk = imgs[i0:i0 + chunk_size]
+    n = chunk.shape[0]
+    hue = _rgb_to_hue(chunk, xmax).reshape(n, -1) * xmax
+
+    # Bin with np.histogram's rules: values outside [xmin, xmax] are dropped
+    # and the last bin includes its right edge.
+    idx = np.searchsorted(bins, hue, side='right') - 1
+    idx[hue == bins[-1]] = nbin - 1
+    valid = (hue >= bins[0]) & (hue <= bins[-1])
+    keys = idx + nbin * np.arange(n)[:, np.newaxis]
+    counts = np.bincount(keys[valid], minlength=n * nbin).reshape(n, nbin)
+
+    if normalized:
+      # Same operations as np.histogram(..., density=True) * np.diff(bins)
+      totals = counts.sum(axis=1, keepdims=True)
+      hists[i0:i0 + n] = counts / bin_widths / totals * bin_widths
+    else:
+      hists[i0:i0 + n] = counts * bin_widths
+
+  return hists
+
+
+def _rgb_to_hue(imgs, xmax):
+  """
+  Hue channel of matplotlib.colors.rgb_to_hsv(imgs / xmax), computed without
+  the saturation and value channels.
+  """
+  arr = imgs[..., :3] / float(xmax)
+  r, g, b = arr[..., 0], arr[..., 1], arr[..., 2]
+  arr_max = arr.max(-1)
+  delta = arr_max - arr.min(-1)
+  ipos = delta > 0
+  hue = np.zeros(arr_max.shape)
+  # Later assignments win, as in rgb_to_hsv: blue, then green, then red
+  with np.errstate(divide='ignore', invalid='ignore'):
+    idx = (r == arr_max) & ipos
+    hue[idx] = (g[idx] - b[idx]) / delta[idx]
+    idx = (g == arr_max) & ipos
+    hue[idx] = 2. + (b[idx] - r[idx]) / delta[idx]
+    idx = (b == arr_max) & ipos
+    hue[idx] = 4. + (r[idx] - g[idx]) / delta[idx]
+  return (hue / 6.0) % 1.0
+
+
+# Batched versions of the feature functions, used by extract_features_cached
+_BATCH_VERSIONS = {
+  hog_feature: hog_feature_batch,
+  color_histogram_hsv: color_histogram_hsv_batch,
+}
@@ -0,0 +1,157 @@
+import itertools
+import math
+import multiprocessing
+import numpy as np
+from cs231n.shared_memory import share_array, open_shared_array
+from cs231n.shared_memory import release_shared_array
+
+
+def search_linear_classifier(model_class, X_train, y_train, X_val, y_val,
+                             learning_rates, regularization_strengths,
+                             num_samples=None, num_iters=1500, batch_size=200,
+                             prune_after=300, keep_fraction=0.5, n_jobs=-1,
+                             seed=0, verbose=False):
+  """
+  Search over learning rates and regularization strengths for a subclass of
+  LinearClassifier, training the configurations in a pool of processes.
+
+  The training and validation arrays are written once to temporary files that
+  every worker memory-maps, so they are not copied into each process.
+
+  Training runs in two stages. Every configuration is first trained for
+  prune_after iterations; configurations whose loss is no longer finite are
+  dropped, and of the rest only the keep_fraction with the best validation
+  accuracy are trained for the remaining num_iters - prune_after iterations.
+
+  Inputs:
+  - model_class: A subclass of LinearClassifier, such as LinearSVM.
+  - X_train, y_train: Training data and labels.
+  - X_val, y_val: Validation data and labels.
+  - learning_rates: List of learning rates. For random search only the
+    smallest and largest values are used.
+  - regularization_strengths: List of regularization strengths, used in the
+    same way as learning_rates.
+  - num_samples: If None, search the full grid. Otherwise draw this many
+    configurations log-uniformly from the ranges of the two lists.
+  - num_iters: Total number of training iterations per configuration.
+  - batch_size: Minibatch size.
+  - prune_after: Number of iterations after which configurations are pruned;
+    if it is not smaller than num_iters nothing is pruned.
+  - keep_fraction: Fraction of the configurations that survive pruning.
+  - n_jobs: Number of worker processes; -1 uses every core and 1 trains in
+    the current process.
+  - seed: Seed for sampling configurations and for each model's training.
+  - verbose: Boolean; if true, print one line per finished configuration.
+
+  Returns a tuple of:
+  - results: A list with one dictionary per configuration, sorted by
+    decreasing validation accuracy, with keys 'learning_rate', 'reg',
+    'train_acc', 'val_acc', 'loss', 'num_iters' and 'pruned'.
+  - best_model: A model_class instance holding the weights of the
+    configuration with the best validation accuracy.
+  """
+  rng = np.random.RandomState(seed)
+  if num_samples is None:
+    configs = list(itertools.product(learning_rates, regularization_strengths))
+  else:
+    lr_range = np.log10([min(learning_rates), max(learning_rates)])
+    reg_range = np.log10([min(regularization_strengths),
+                          max(regularization_strengths)])
+    configs = zip(10 ** rng.uniform(lr_range[0], lr_range[1], num_samples),
+                  10 ** rng.uniform(reg_range[0], reg_range[1], num_samples))
+  seeds = rng.randint(2 ** 31 - 1, size=len(configs))
+
+  if n_jobs < 0:
+    n_jobs = multiprocessing.cpu_count()
+  arrays = (X_train, y_train, X_val, y_val)
+  handles = ()
+  if n_jobs == 1:
+    pool = None
+    _init_worker(arrays, shared=False)
+  else:
+    handles = tuple(share_array(a) for a in arrays)
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                initargs=(handles,))
+  try:
+    results = _run_search(pool, model_class, configs, seeds, num_iters,
+                          batch_size, prune_after, keep_fraction)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    for handle in handles:
+      release_shared_array(handle)
+    _init_worker(None, shared=False)
+
+  results.sort(key=lambda r: r['val_acc'], reverse=True)
+  best_model = model_class()
+  best_model.W = results[0]['W']
+  for r in results:
+    del r['W'], r['seed']
+    if verbose:
+      print 'lr %e reg %e iters %d train accuracy: %f val accuracy: %f%s' % (
+          r['learning_rate'], r['reg'], r['num_iters'], r['train_acc'],
+          r['val_acc'], ' (pruned)' if r['pruned'] else '')
+  return results, best_model
+
+
+def _run_search(pool, model_class, configs, seeds, num_iters, batch_size,
+                prune_after, keep_fraction):
+  """
+  Run both training stages of search_linear_classifier in pool, or in the
+  current process if pool is None, and return the unsorted results.
+  """
+  run = map if pool is None else pool.map
+
+  first_iters = min(prune_after, num_iters)
+  jobs = [(model_class, lr, reg, None, first_iters, batch_size, s)
+          for (lr, reg), s in zip(configs, seeds)]
+  results = run(_train_config, jobs)
+
+  if first_iters < num_iters:
+    finite = [i for i, r in enumerate(results) if np.isfinite(r['loss'])]
+    finite.sort(key=lambda i: results[i]['val_acc'], reverse=True)
+    survivors = finite[:int(math.ceil(keep_fraction * len(finite)))]
+    for r in results:
+      r['pruned'] = True
+    jobs = [(model_class, results[i]['learning_rate'], results[i]['reg'],
+             results[i]['W'], num_iters - first_iters, batch_size,
+             results[i]['seed'] + 1)
+            for i in survivors]
+    for i, final in zip(survivors, run(_train_config, jobs)):
+      final['num_iters'] += results[i]['num_iters']
+      results[i] = final
+  return results
+
+
+# Arrays (X_train, y_train, X_val, y_val) used by _train_config; set once per
+# worker process by _init_worker.
+_worker_arrays = None
+
+
+def _init_worker(arrays, shared=True):
+  global _worker_arrays
+  if shared:
+    arrays = tuple(open_shared_array(handle) for handle in arrays)
+  _worker_arrays = arrays
+
+
+def _train_config(job):
+  model_class, learning_rate, reg, W, num_iters, batch_size, seed = job
+  X_train, y_train, X_val, y_val = _worker_arrays
+  model = model_class()
+  model.W = W
+  loss_history = model.train(X_train, y_train, learning_rate=learning_rate,
+                             reg=reg, num_iters=num_iters,
+                             batch_size=batch_size, seed=seed)
+  return {
+    'learning_rate': learning_rate,
+    'reg': reg,
+    'train_acc': np.mean(model.predict(X_train) == y_train),
+    'val_acc': np.mean(model.predict(X_val) == y_val),
+    'loss': loss_history[-1],
+    'num_iters': num_iters,
+    'pruned': False,
+    'W': model.W,
+    'seed': seed,
+  }
@@ -0,0 +1,150 @@
+import sys
+import threading
+import Queue
+import numpy as np
+
+
+class MinibatchIterator(object):
+  """
+  Iterate over minibatches of a dataset in epochs. Each epoch visits the data
+  in a fresh random permutation; a minibatch that runs past the end of an
+  epoch is completed with the first indices of the next one, so every batch
+  has exactly batch_size examples.
+
+  Batches are gathered with np.take into preallocated buffers, so no new
+  arrays are allocated per iteration. The arrays returned by next() are only
+  valid until the following call to next(); copy them if they must be kept.
+
+  With prefetch=True a background thread gathers the next batch while the
+  caller works on the current one. Call close() to stop the thread. If the
+  thread fails to gather a batch, the error is raised by next().
+
+  Example usage:
+
+  batches = MinibatchIterator(X, y, batch_size=200)
+  for it in xrange(num_iters):
+    X_batch, y_batch = batches.next()
+    ...
+  batches.close()
+  """
+
+  def __init__(self, X, y, batch_size, shuffle=True, prefetch=False,
+               seed=None):
+    """
+    Inputs:
+    - X: A numpy array of shape (N, ...) of data.
+    - y: A numpy array of shape (N,) of labels.
+    - batch_size: Number of examples per minibatch.
+    - shuffle: If False, iterate in the original order of the data.
+    - prefetch: If True, gather batches in a background thread.
+    - seed: Optional seed for the permutations; if None the global numpy
+      random state is used, so np.random.seed controls the batches.
+    """
+    self.X = X
+    self.y = y
+    self.num_train = X.shape[0]
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.rng = np.random if seed is None else np.random.RandomState(seed)
+    self.epoch = 0
+    self._order = self._new_order()
+    self._pos = 0
+    self._idx = np.empty(batch_size, dtype=np.intp)
+
+    # With prefetching, one buffer is held by the caller, one waits in the
+    # ready queue and one is being filled by the worker thread.
+    num_buffers = 3 if prefetch else 1
+    self._buffers = [self._new_buffer() for _ in xrange(num_buffers)]
+    self._current = None
+    self._thread = None
+    self._error = None
+    if prefetch:
+      self._free = Queue.Queue()
+      self._ready = Queue.Queue()
+      for buf in self._buffers:
+        self._free.put(buf)
+      self._stop = threading.Event()
+      self._thread = threading.Thread(target=self._worker)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    """
+    Return the next minibatch as a tuple (X_batch, y_batch) of arrays of
+    shape (batch_size, ...) and (batch_size,).
+    """
+    if self._thread is None:
+      buf = self._buffers[0]
+      self._fill(buf)
+      return buf
+    if self._current is not None:
+      self._free.put(self._current)
+    self._current = self._ready.get()
+    if self._current is None:
+      # The worker thread failed and has exited; leave the marker so that
+      # later calls raise too.
+      self._ready.put(None)
+      exc_type, exc_value, exc_tb = self._error
+      raise exc_type, exc_value, exc_tb
+    return self._current
+
+  def close(self):
+    """
+    Stop the prefetch thread, if there is one.
+    """
+    if self._thread is not None:
+      self._stop.set()
+      self._free.put(None)
+      self._thread.join()
+      self._thread = None
+
+  def _new_order(self):
+    if self.shuffle:
+      return self.rng.permutation(self.num_train)
+    return np.arange(self.num_train)
+
+  def _new_buffer(self):
+    X_buf = np.empty((self.batch_size,) + self.X.shape[1:], dtype=self.X.dtype)
+    y_buf = np.empty(self.batch_size, dtype=self.y.dtype)
+    return X_buf, y_buf
+
+  def _next_indices(self):
+    """
+    Fill self._idx with the next batch_size indices, starting a new epoch
+    whenever the current permutation runs out.
+    """
+    filled = 0
+    while filled < self.batch_size:
+      count = min(self.batch_size - filled, self.num_train - self._pos)
+      self._idx[filled:filled + count] = self._order[self._pos:self._pos + count]
+      filled += count
+      self._pos += count
+      if self._pos == self.num_train:
+        self.epoch += 1
+        self._order = self._new_order()
+        self._pos = 0
+    return self._idx
+
+  def _fill(self, buf):
+    idx = self._next_indices()
+    X_buf, y_buf = buf
+    # mode='clip' avoids the extra buffering that mode='raise' does for out=;
+    # the indices are always in range.
+    np.take(self.X, idx, axis=0, out=X_buf, mode='clip')
+    np.take(self.y, idx, axis=0, out=y_buf, mode='clip')
+
+  def _worker(self):
+    while True:
+      buf = self._free.get()
+      if buf is None or self._stop.is_set():
+        return
+      try:
+        self._fill(buf)
+      except Exception:
+        self._error = sys.exc_info()
+        self._ready.put(None)
+        return
+      self._ready.put(buf)
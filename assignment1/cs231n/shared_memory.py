@@ -0,0 +1,60 @@
+import atexit
+import os
+import tempfile
+import numpy as np
+
+
+def share_array(X):
+  """
+  Write an array to a temporary .npy file so that worker processes can
+  memory-map it read-only instead of receiving a pickled copy. The file holds
+  a full copy of X, so pass the handle to release_shared_array once the
+  workers are done with it; any file that is not released is removed when
+  the interpreter exits.
+
+  Inputs:
+  - X: A numpy array.
+
+  Returns:
+  A small picklable handle that can be passed to open_shared_array.
+  """
+  fd, filename = tempfile.mkstemp(suffix='.npy')
+  os.close(fd)
+  atexit.register(_remove_file, filename)
+  X_shared = np.lib.format.open_memmap(filename, mode='w+', dtype=X.dtype,
+                                       shape=X.shape)
+  X_shared[...] = X
+  handle = (filename, X_shared.dtype.str, X_shared.shape, X_shared.offset)
+  del X_shared
+  return handle
+
+
+def open_shared_array(handle):
+  """
+  Memory-map an array written by share_array.
+
+  Inputs:
+  - handle: A handle returned by share_array.
+
+  Returns:
+  A read-only numpy memmap of the shared array.
+  """
+  filename, dtype, shape, offset = handle
+  return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+
+def release_shared_array(handle):
+  """
+  Remove the file behind a handle returned by share_array. Memmaps that are
+  still open keep working until they are closed, but open_shared_array can
+  no longer be called with the handle.
+
+  Inputs:
+  - handle: A handle returned by share_array.
+  """
+  _remove_file(handle[0])
+
+
+def _remove_file(filename):
+  if os.path.exists(filename):
+    os.remove(filename)
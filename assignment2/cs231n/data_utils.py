@@ -1,6 +1,11 @@
 import cPickle as pickle
+import itertools
+import json
+import multiprocessing
 import numpy as np
 import os
+import time
+from numpy.lib.format import open_memmap
 from scipy.misc import imread
 
 def load_CIFAR_batch(filename):
@@ -29,14 +34,224 @@ def load_CIFAR10(ROOT):
   return Xtr, Ytr, Xte, Yte
 
 
-def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000):
+def pack_CIFAR10(ROOT, layout='NCHW'):
+  """
+  Convert the pickled CIFAR-10 batches in ROOT into one packed uint8 .npy file
+  of images, a .npy file of labels and a small JSON index of the train and
+  test ranges, all stored in ROOT. This only has to be done once; afterwards
+  load_CIFAR10_packed memory-maps the images instead of unpickling them.
+
+  Inputs:
+  - ROOT: Directory containing the CIFAR-10 python batches.
+  - layout: Either 'NCHW' (channels first, the order of the raw data) or
+    'NHWC' (channels last, as returned by load_CIFAR10).
+
+  Returns:
+  The path of the index file.
+  """
+  images_path, labels_path, index_path = _CIFAR10_packed_paths(ROOT, layout)
+  batch_files = ['data_batch_%d' % b for b in range(1, 6)] + ['test_batch']
+  num_images = 10000 * len(batch_files)
+  image_shape = (3, 32, 32) if layout == 'NCHW' else (32, 32, 3)
+  X = open_memmap(images_path, mode='w+', dtype=np.uint8,
+                  shape=(num_images,) + image_shape)
+  y = np.zeros(num_images, dtype=np.int64)
+  for i, batch_file in enumerate(batch_files):
+    with open(os.path.join(ROOT, batch_file), 'rb') as f:
+      datadict = pickle.load(f)
+    data = np.asarray(datadict['data'], dtype=np.uint8).reshape(10000, 3, 32, 32)
+    if layout == 'NHWC':
+      data = data.transpose(0, 2, 3, 1)
+    X[i * 10000:(i + 1) * 10000] = data
+    y[i * 10000:(i + 1) * 10000] = datadict['labels']
+  X.flush()
+  del X
+  np.save(labels_path, y)
+
+  # The index is written last, so its presence means the cache is complete
+  index = {'layout': layout, 'train': [0, 50000], 'test': [50000, 60000]}
+  with open(index_path, 'w') as f:
+    json.dump(index, f)
+  return index_path
+
+
+def load_CIFAR10_packed(ROOT, layout='NCHW'):
+  """
+  Load CIFAR-10 from the packed cache written by pack_CIFAR10, creating it
+  first if needed. The images are returned as read-only uint8 memory maps in
+  the requested layout, so loading takes no time and no memory; use
+  LazyImageArray to convert minibatches to floating point as they are read.
+
+  Inputs:
+  - ROOT: Directory containing the CIFAR-10 python batches.
+  - layout: Either 'NCHW' or 'NHWC'; see pack_CIFAR10.
+
+  Returns: Same as load_CIFAR10, except that the images are uint8 memmaps.
+  """
+  if layout not in ('NCHW', 'NHWC'):
+    raise ValueError('Invalid layout "%s"' % layout)
+  images_path, labels_path, index_path = _CIFAR10_packed_paths(ROOT, layout)
+  if not os.path.exists(index_path):
+    pack_CIFAR10(ROOT, layout)
+  with open(index_path, 'r') as f:
+    index = json.load(f)
+  X = np.load(images_path, mmap_mode='r')
+  y = np.load(labels_path)
+  train, test = slice(*index['train']), slice(*index['test'])
+  return X[train], y[train], X[test], y[test]
+
+
+def _CIFAR10_packed_paths(ROOT, layout):
+  prefix = os.path.join(ROOT, 'cifar10_%s' % layout.lower())
+  return prefix + '_uint8.npy', prefix + '_labels.npy', prefix + '_index.json'
+
+
+def compute_image_stats(X, chunk_size=5000):
+  """
+  Compute the per-pixel mean and standard deviation of an array of images in
+  a single streaming pass, converting only chunk_size images at a time to
+  float64. X can be a memmap much larger than memory. Chunk statistics are
+  combined with the pairwise update of Chan et al., which is as accurate as
+  computing them over the whole array at once.
+
+  Inputs:
+  - X: Array of images of shape (N, ...).
+  - chunk_size: Number of images converted to floating point at a time.
+
+  Returns a tuple of:
+  - mean: Array of shape X.shape[1:] giving the mean image.
+  - std: Array of shape X.shape[1:] giving the standard deviation of each
+    pixel.
+  """
+  count = 0
+  mean = np.zeros(X.shape[1:])
+  m2 = np.zeros(X.shape[1:])
+  for i in xrange(0, X.shape[0], chunk_size):
+    chunk = np.array(X[i:i + chunk_size], dtype=np.float64)
+    n = chunk.shape[0]
+    chunk_mean = chunk.mean(axis=0)
+    chunk -= chunk_mean
+    chunk *= chunk
+    delta = chunk_mean - mean
+    total = count + n
+    mean += delta * (float(n) / total)
+    m2 += chunk.sum(axis=0)
+    m2 += delta ** 2 * (float(count) * n / total)
+    count = total
+  return mean, np.sqrt(m2 / count)
+
+
+def load_CIFAR10_stats(ROOT, num_training, layout='NCHW', chunk_size=5000):
+  """
+  Return the per-pixel mean and standard deviation of the first num_training
+  CIFAR-10 training images, as computed by compute_image_stats over the
+  packed cache. The statistics are saved next to the cache the first time
+  they are computed and loaded from there afterwards.
+
+  Inputs:
+  - ROOT: Directory containing the CIFAR-10 python batches.
+  - num_training: Number of training images the statistics are taken over.
+  - layout: Either 'NCHW' or 'NHWC'; see pack_CIFAR10.
+  - chunk_size: Number of images processed at a time.
+
+  Returns a tuple (mean, std) of arrays of shape (3, 32, 32) or (32, 32, 3).
+  """
+  stats_path = os.path.join(ROOT, 'cifar10_%s_stats_%d.npz' % (layout.lower(),
+                                                                num_training))
+  if os.path.exists(stats_path):
+    stats = np.load(stats_path)
+    return stats['mean'], stats['std']
+  X_train = load_CIFAR10_packed(ROOT, layout)[0][:num_training]
+  mean, std = compute_image_stats(X_train, chunk_size)
+  np.savez(stats_path, mean=mean, std=std)
+  return mean, std
+
+
+class LazyImageArray(object):
+  """
+  A read-only wrapper around an integer image array, such as the memmaps from
+  load_CIFAR10_packed, that converts to floating point only the rows that are
+  indexed and optionally normalizes them on the way. Indexing it with
+  an integer, a slice or an index array returns a new float array, so it can
+  be passed anywhere the code only reads minibatches, such as a Solver.
+  """
+
+  def __init__(self, data, dtype=np.float32, mean=None, std=None):
+    """
+    Inputs:
+    - data: Array of images of shape (N, ...).
+    - dtype: Floating point datatype of the returned minibatches.
+    - mean: Optional array broadcastable to data.shape[1:] that is subtracted
+      from every returned image.
+    - std: Optional array broadcastable to data.shape[1:]; every returned
+      image is divided by it after the mean is subtracted. Entries that are
+      zero are treated as one.
+    """
+    self.data = data
+    self.dtype = np.dtype(dtype)
+    self.mean = None if mean is None else np.asarray(mean, dtype=dtype)
+    self.scale = None
+    if std is not None:
+      std = np.asarray(std, dtype=np.float64)
+      self.scale = (1.0 / np.where(std > 0, std, 1.0)).astype(dtype)
+
+  @property
+  def shape(self):
+    return self.data.shape
+
+  @property
+  def ndim(self):
+    return self.data.ndim
+
+  def __len__(self):
+    return self.data.shape[0]
+
+  def __getitem__(self, idx):
+    batch = np.array(self.data[idx], dtype=self.dtype)
+    if self.mean is not None:
+      batch -= self.mean
+    if self.scale is not None:
+      batch *= self.scale
+    return batch
+
+
+def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
+                     lazy=False, normalize=False):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    If lazy is True, the images come from the packed uint8 cache of
+    load_CIFAR10_packed in channels-first layout, and each split is a
+    LazyImageArray that converts to float32 and subtracts the mean only for
+    the minibatches that are read from it. Nothing is transposed or copied.
+    The mean and standard deviation are computed in one streaming pass and
+    saved next to the cache by load_CIFAR10_stats.
+
+    If normalize is True, every pixel is also divided by its standard
+    deviation over the training images.
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
+    if lazy:
+      X_train, y_train, X_test, y_test = load_CIFAR10_packed(cifar10_dir)
+      X_val = X_train[num_training:num_training + num_validation]
+      y_val = y_train[num_training:num_training + num_validation]
+      X_train, y_train = X_train[:num_training], y_train[:num_training]
+      X_test, y_test = X_test[:num_test], y_test[:num_test]
+      mean_image, std_image = load_CIFAR10_stats(cifar10_dir, num_training)
+      if not normalize:
+        std_image = None
+      return {
+        'X_train': LazyImageArray(X_train, mean=mean_image, std=std_image),
+        'y_train': y_train,
+        'X_val': LazyImageArray(X_val, mean=mean_image, std=std_image),
+        'y_val': y_val,
+        'X_test': LazyImageArray(X_test, mean=mean_image, std=std_image),
+        'y_test': y_test,
+      }
+
     X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
         
     # Subsample the data
@@ -51,10 +266,15 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000):
     y_test = y_test[mask]
 
     # Normalize the data: subtract the mean image
-    mean_image = np.mean(X_train, axis=0)
+    mean_image, std_image = compute_image_stats(X_train)
     X_train -= mean_image
     X_val -= mean_image
     X_test -= mean_image
+    if normalize:
+      std_image[std_image == 0] = 1.0
+      X_train /= std_image
+      X_val /= std_image
+      X_test /= std_image
     
     # Transpose so that channels come first
     X_train = X_train.transpose(0, 3, 1, 2).copy()
@@ -176,6 +396,198 @@ def load_tiny_imagenet(path, dtype=np.float32):
   return class_names, X_train, y_train, X_val, y_val, X_test, y_test
 
 
+def pack_tiny_imagenet(path, n_jobs=-1, chunk_size=500, verbose=True):
+  """
+  Decode every TinyImageNet image once into a packed uint8 .npy file of shape
+  (N, 3, 64, 64) holding the train, val and test images in that order, plus
+  a small JSON index and an .npz file of labels and the mean training image,
+  all stored in path. Afterwards load_tiny_imagenet_packed memory-maps the
+  images instead of decoding them again.
+
+  Chunks of chunk_size images are decoded by a pool of worker processes that
+  write straight into the memory-mapped output file. Finished chunks are
+  recorded on disk, so if packing is interrupted, calling this again resumes
+  from the first unfinished chunk.
+
+  Inputs:
+  - path: String giving path to the directory to load.
+  - n_jobs: Number of worker processes; -1 uses every core and 1 decodes in
+    the current process.
+  - chunk_size: Number of images decoded per job.
+  - verbose: Boolean; if true, print progress and throughput.
+
+  Returns:
+  The path of the index file.
+  """
+  images_path, meta_path, index_path, manifest_path, done_path = \
+    _tiny_imagenet_packed_paths(path)
+  class_names, files, labels = _list_tiny_imagenet(path)
+  all_files = files['train'] + files['val'] + files['test']
+  num_images = len(all_files)
+  starts = range(0, num_images, chunk_size)
+
+  # Resume an interrupted run only if it was packing the same files
+  manifest = {'files': all_files, 'chunk_size': chunk_size}
+  done = None
+  if os.path.exists(manifest_path) and os.path.exists(images_path):
+    with open(manifest_path, 'r') as f:
+      if json.load(f) == manifest:
+        done = np.load(done_path)
+  if done is None:
+    X = open_memmap(images_path, mode='w+', dtype=np.uint8,
+                    shape=(num_images, 3, 64, 64))
+    del X
+    done = np.zeros(len(starts), dtype=bool)
+    np.save(done_path, done)
+    with open(manifest_path, 'w') as f:
+      json.dump(manifest, f)
+
+  jobs = [(images_path, path, i, start, all_files[start:start + chunk_size])
+          for i, start in enumerate(starts) if not done[i]]
+  if n_jobs < 0:
+    n_jobs = multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 and len(jobs) > 1 else None
+  run = itertools.imap if pool is None else pool.imap_unordered
+  num_todo = sum(len(job[4]) for job in jobs)
+  if verbose and num_todo < num_images:
+    print 'resuming: %d / %d images already packed' % (num_images - num_todo,
+                                                       num_images)
+  num_decoded = 0
+  tic = time.time()
+  try:
+    for n, (i, count) in enumerate(run(_decode_tiny_imagenet_chunk, jobs)):
+      done[i] = True
+      np.save(done_path, done)
+      num_decoded += count
+      if verbose and ((n + 1) % 20 == 0 or n + 1 == len(jobs)):
+        print 'decoded %d / %d images (%.1f images/sec)' % (
+            num_decoded, num_todo, num_decoded / (time.time() - tic))
+  finally:
+    # All jobs have finished unless there was an error or an interrupt; the
+    # chunks recorded as done so far are kept for the next call to resume.
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+
+  num_train, num_val = len(files['train']), len(files['val'])
+  X_train = np.load(images_path, mmap_mode='r')[:num_train]
+  mean_image = compute_image_stats(X_train)[0]
+  del X_train
+  meta = {'y_train': labels['train'], 'y_val': labels['val'],
+          'mean_image': mean_image}
+  if labels['test'] is not None:
+    meta['y_test'] = labels['test']
+  np.savez(meta_path, **meta)
+
+  # The index is written last, so its presence means the cache is complete
+  index = {
+    'class_names': class_names,
+    'train': [0, num_train],
+    'val': [num_train, num_train + num_val],
+    'test': [num_train + num_val, num_images],
+  }
+  with open(index_path, 'w') as f:
+    json.dump(index, f)
+  os.remove(manifest_path)
+  os.remove(done_path)
+  return index_path
+
+
+def _tiny_imagenet_packed_paths(path):
+  prefix = os.path.join(path, 'tiny_imagenet')
+  return (prefix + '_uint8.npy', prefix + '_meta.npz', prefix + '_index.json',
+          prefix + '_manifest.json', prefix + '_done.npy')
+
+
+def _list_tiny_imagenet(path):
+  """
+  Return (class_names, files, labels) for the TinyImageNet directory at path,
+  where files and labels are dictionaries keyed by 'train', 'val' and 'test'.
+  Files are given relative to path and are in the same order as in
+  load_tiny_imagenet; labels['test'] is None if test labels are not available.
+  """
+  with open(os.path.join(path, 'wnids.txt'), 'r') as f:
+    wnids = [x.strip() for x in f]
+  wnid_to_label = {wnid: i for i, wnid in enumerate(wnids)}
+  with open(os.path.join(path, 'words.txt'), 'r') as f:
+    wnid_to_words = dict(line.split('\t') for line in f)
+  class_names = [[w.strip() for w in wnid_to_words[wnid].split(',')]
+                 for wnid in wnids]
+
+  files = {'train': []}
+  y_train = []
+  for wnid in wnids:
+    boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
+    with open(boxes_file, 'r') as f:
+      filenames = [x.split('\t')[0] for x in f]
+    files['train'].extend(os.path.join('train', wnid, 'images', img_file)
+                          for img_file in filenames)
+    y_train.extend([wnid_to_label[wnid]] * len(filenames))
+
+  with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
+    val_annotations = [line.split('\t')[:2] for line in f]
+  files['val'] = [os.path.join('val', 'images', img_file)
+                  for img_file, _ in val_annotations]
+  y_val = [wnid_to_label[wnid] for _, wnid in val_annotations]
+
+  img_files = os.listdir(os.path.join(path, 'test', 'images'))
+  files['test'] = [os.path.join('test', 'images', img_file)
+                   for img_file in img_files]
+  y_test = None
+  y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
+  if os.path.isfile(y_test_file):
+    with open(y_test_file, 'r') as f:
+      img_file_to_wnid = dict(line.split('\t')[:2] for line in f)
+    y_test = np.array([wnid_to_label[img_file_to_wnid[img_file]]
+                       for img_file in img_files])
+
+  labels = {'train': np.array(y_train, dtype=np.int64), 'val': np.array(y_val),
+            'test': y_test}
+  return class_names, files, labels
+
+
+def _decode_tiny_imagenet_chunk(job):
+  images_path, path, i, start, filenames = job
+  X = np.load(images_path, mmap_mode='r+')
+  for j, img_file in enumerate(filenames):
+    img = imread(os.path.join(path, img_file))
+    if img.ndim == 2:
+      ## grayscale file
+      img.shape = (64, 64, 1)
+    X[start + j] = img.transpose(2, 0, 1)
+  X.flush()
+  return i, len(filenames)
+
+
+def load_tiny_imagenet_packed(path, dtype=np.float32, n_jobs=-1, verbose=True):
+  """
+  Load TinyImageNet from the packed cache written by pack_tiny_imagenet,
+  creating it first if needed. Once the cache exists this only memory-maps
+  one file, so it returns immediately.
+
+  Inputs:
+  - path: String giving path to the directory to load.
+  - dtype: numpy datatype of the images read from the returned arrays.
+  - n_jobs, verbose: Passed to pack_tiny_imagenet if the cache is built.
+
+  Returns: The same tuple as load_tiny_imagenet, except that X_train, X_val
+  and X_test are LazyImageArrays over the uint8 cache, which convert images
+  to dtype as they are indexed.
+  """
+  images_path, meta_path, index_path = _tiny_imagenet_packed_paths(path)[:3]
+  if not os.path.exists(index_path):
+    pack_tiny_imagenet(path, n_jobs=n_jobs, verbose=verbose)
+  with open(index_path, 'r') as f:
+    index = json.load(f)
+  X = np.load(images_path, mmap_mode='r')
+  meta = np.load(meta_path)
+  X_train, X_val, X_test = [LazyImageArray(X[slice(*index[split])], dtype)
+                            for split in ('train', 'val', 'test')]
+  y_test = meta['y_test'] if 'y_test' in meta.files else None
+  return (index['class_names'], X_train, meta['y_train'], X_val, meta['y_val'],
+          X_test, y_test)
+
+
 def load_models(models_dir):
   """
   Load saved models from disk. This will attempt to unpickle all files in a
@@ -188,6 +600,10 @@ def load_models(models_dir):
 
   Returns:
   A dictionary mapping model file names to models.
+
+  This loads every model into memory; to pick one model out of a directory of
+  large checkpoints, convert the directory once with ModelStore.import_pickled
+  and use the ModelStore instead.
   """
   models = {}
   for model_file in os.listdir(models_dir):
@@ -197,3 +613,176 @@ def load_models(models_dir):
       except pickle.UnpicklingError:
         continue
   return models
+
+
+class ModelStore(object):
+  """
+  A directory of saved models that can be listed and searched without loading
+  any parameters. Each model is stored as a subdirectory holding one
+  uncompressed .npy file per parameter, and a JSON index in the root records
+  for every model its architecture, validation accuracy, parameter shapes and
+  size, along with any other metadata given when it was saved.
+
+  Loading a model memory-maps its parameter files, so only the parameters
+  that are actually read are brought into memory.
+
+  Example usage:
+
+  store = ModelStore('cs231n/models')
+  store.import_pickled('old_models')  # one-time conversion
+  name = store.best('val_acc')
+  model = store[name]
+  """
+
+  def __init__(self, root):
+    """
+    Inputs:
+    - root: String giving the path to the store directory; it is created if
+      it does not exist.
+    """
+    self.root = root
+    self.index_path = os.path.join(root, 'index.json')
+    if not os.path.isdir(root):
+      os.makedirs(root)
+    self.index = {}
+    if os.path.exists(self.index_path):
+      with open(self.index_path, 'r') as f:
+        self.index = json.load(f)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, name):
+    return name in self.index
+
+  def __getitem__(self, name):
+    return self.load(name)
+
+  def names(self):
+    """
+    Return a sorted list of the names of the stored models.
+    """
+    return sorted(self.index)
+
+  def metadata(self, name):
+    """
+    Return the metadata dictionary of a stored model, with keys 'name',
+    'architecture', 'val_acc', 'shapes', 'dtypes', 'num_params' and 'nbytes'
+    plus any extra metadata given to save.
+    """
+    return self.index[name]
+
+  def best(self, key='val_acc'):
+    """
+    Return the name of the model with the largest value of a metadata key,
+    ignoring models that do not have it.
+    """
+    candidates = [name for name in self.index
+                  if self.index[name].get(key) is not None]
+    if not candidates:
+      raise KeyError('No stored model has metadata "%s"' % key)
+    return max(candidates, key=lambda name: self.index[name][key])
+
+  def save(self, name, model, architecture=None, val_acc=None, **metadata):
+    """
+    Store a model, replacing any stored model with the same name.
+
+    Inputs:
+    - name: String naming the model; used as a directory name.
+    - model: Dictionary mapping parameter names to numpy arrays.
+    - architecture: Optional string describing the architecture.
+    - val_acc: Optional validation accuracy.
+    - metadata: Any other JSON-serializable metadata to keep in the index.
+    """
+    if not name or os.sep in name or name.startswith('.'):
+      raise ValueError('Invalid model name "%s"' % name)
+    model_dir = os.path.join(self.root, name)
+    if not os.path.isdir(model_dir):
+      os.makedirs(model_dir)
+    for param_file in os.listdir(model_dir):
+      os.remove(os.path.join(model_dir, param_file))
+    params = dict((k, np.asarray(v)) for k, v in model.iteritems())
+    for k, v in params.iteritems():
+      np.save(os.path.join(model_dir, '%s.npy' % k), v)
+
+    entry = dict(metadata)
+    entry.update({
+      'name': name,
+      'architecture': architecture,
+      'val_acc': None if val_acc is None else float(val_acc),
+      'shapes': dict((k, list(v.shape)) for k, v in params.iteritems()),
+      'dtypes': dict((k, v.dtype.str) for k, v in params.iteritems()),
+      'num_params': sum(int(v.size) for v in params.itervalues()),
+      'nbytes': sum(int(v.nbytes) for v in params.itervalues()),
+    })
+    self.index[name] = entry
+    self._write_index()
+
+  def load(self, name, mmap_mode='r'):
+    """
+    Load the parameters of a stored model.
+
+    Inputs:
+    - name: Name of the model.
+    - mmap_mode: Passed to np.load; the default memory-maps the parameters
+      read-only. Use None to read them into memory, or 'c' for writable
+      copy-on-write arrays.
+
+    Returns:
+    A dictionary mapping parameter names to arrays.
+    """
+    if name not in self.index:
+      raise KeyError('No stored model named "%s"' % name)
+    model_dir = os.path.join(self.root, name)
+    return dict((k, np.load(os.path.join(model_dir, '%s.npy' % k),
+                            mmap_mode=mmap_mode))
+                for k in self.index[name]['shapes'])
+
+  def remove(self, name):
+    """
+    Delete a stored model.
+    """
+    model_dir = os.path.join(self.root, name)
+    for k in self.index[name]['shapes']:
+      os.remove(os.path.join(model_dir, '%s.npy' % k))
+    os.rmdir(model_dir)
+    del self.index[name]
+    self._write_index()
+
+  def import_pickled(self, models_dir):
+    """
+    Add the models in a directory of pickled model files, as read by
+    load_models, to the store. Scalar and string entries of each pickled
+    dictionary other than 'model' become metadata. Files that cannot be
+    unpickled are skipped.
+
+    Inputs:
+    - models_dir: String giving the path to a directory of model files.
+
+    Returns:
+    A list of the names of the imported models.
+    """
+    imported = []
+    for model_file in sorted(os.listdir(models_dir)):
+      path = os.path.join(models_dir, model_file)
+      if not os.path.isfile(path):
+        continue
+      with open(path, 'rb') as f:
+        try:
+          checkpoint = pickle.load(f)
+        except Exception:
+          continue
+      if not isinstance(checkpoint, dict) or 'model' not in checkpoint:
+        continue
+      metadata = dict((k, v) for k, v in checkpoint.iteritems()
+                      if k != 'model' and isinstance(v, (int, long, float, str)))
+      self.save(model_file, checkpoint['model'], **metadata)
+      imported.append(model_file)
+    return imported
+
+  def _write_index(self):
+    # Write to a temporary file first so a crash never leaves a broken index
+    tmp_path = self.index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.index, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, self.index_path)
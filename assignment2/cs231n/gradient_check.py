@@ -1,13 +1,25 @@
+import hashlib
+import math
+import multiprocessing
 import numpy as np
 from random import randrange
 
-def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
+def eval_numerical_gradient(f, x, verbose=True, h=0.00001, n_jobs=1):
   """ 
   a naive implementation of numerical gradient of f at x 
   - f should be a function that takes a single argument
   - x is the point (numpy array) to evaluate the gradient at
+  - n_jobs: number of worker processes to split the coordinates over; -1
+    uses every core. f and x are shared with the workers by forking.
   """ 
 
+  if n_jobs != 1:
+    grad = _parallel_numerical_gradient(f, x, None, h, n_jobs)
+    if verbose:
+      for ix in np.ndindex(*x.shape):
+        print ix, grad[ix]
+    return grad
+
   fx = f(x) # evaluate function value at original point
   grad = np.zeros_like(x)
   # iterate over all indexes in x
@@ -32,11 +44,17 @@ def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
   return grad
 
 
-def eval_numerical_gradient_array(f, x, df, h=1e-5):
+def eval_numerical_gradient_array(f, x, df, h=1e-5, n_jobs=1):
   """
   Evaluate a numeric gradient for a function that accepts a numpy
   array and returns a numpy array.
+
+  If n_jobs is not 1 the coordinates are split over that many worker
+  processes (-1 uses every core); f, x and df are shared by forking.
   """
+  if n_jobs != 1:
+    return _parallel_numerical_gradient(f, x, df, h, n_jobs)
+
   grad = np.zeros_like(x)
   it = np.nditer(x, flags=['multi_index'], op_flags=['readwrite'])
   while not it.finished:
@@ -101,6 +119,148 @@ def eval_numerical_gradient_net(net, inputs, output, h=1e-5):
               inputs, output, h=h)
 
 
+def eval_numerical_gradient_batched(f, x, df, h=1e-5):
+  """
+  Evaluate a numeric gradient like eval_numerical_gradient_array, for a
+  function f that is separable over the first axis: f(x)[i] depends only on
+  x[i], as is the case for every layer in layers.py with respect to its
+  input. The same coordinate of every example is perturbed at once, so this
+  takes 2 * x[0].size calls to f instead of 2 * x.size.
+
+  Inputs:
+  - f: Function taking an array of shape (N, ...) and returning an array of
+    shape (N, ...).
+  - x: Array of shape (N, ...) at which to evaluate the gradient.
+  - df: Upstream gradient with the shape of f(x).
+  - h: Step size.
+
+  Returns:
+  The gradient of np.sum(f(x) * df) with respect to x.
+  """
+  N = x.shape[0]
+  grad = np.zeros_like(x)
+  df = df.reshape(N, -1)
+  for ix in np.ndindex(*x.shape[1:]):
+    idx = (slice(None),) + ix
+    oldval = x[idx].copy()
+    x[idx] = oldval + h
+    pos = f(x).reshape(N, -1).copy()
+    x[idx] = oldval - h
+    neg = f(x).reshape(N, -1).copy()
+    x[idx] = oldval
+    grad[idx] = np.sum((pos - neg) * df, axis=1) / (2 * h)
+  return grad
+
+
+def check_directional_derivatives(f, x, analytic_grad, df=None,
+                                  num_directions=5, h=1e-5, seed=0):
+  """
+  Check a whole analytic gradient with a few evaluations of f by comparing
+  directional derivatives along random directions v: the centered difference
+  (f(x + h v) - f(x - h v)) / 2h against the dot product of analytic_grad and
+  v. A wrong entry anywhere in the gradient shows up in every direction, so a
+  handful of directions is enough to catch it, but it does not say which
+  entry is wrong; use eval_numerical_gradient for that.
+
+  Inputs:
+  - f: Function of x returning a scalar, or an array if df is given.
+  - x: Array at which to check the gradient.
+  - analytic_grad: The gradient to check, with the shape of x.
+  - df: If not None, the upstream gradient of an array-valued f; the
+    function checked is then np.sum(f(x) * df).
+  - num_directions: Number of random directions; each costs two calls to f.
+  - h: Step size along each unit direction.
+  - seed: Seed for the random directions.
+
+  Returns:
+  An array of shape (num_directions,) of relative errors, one per direction.
+  """
+  rng = np.random.RandomState(seed)
+  oldval = x.copy()
+  rel_errors = np.zeros(num_directions)
+  for i in xrange(num_directions):
+    v = rng.randn(*x.shape)
+    v /= np.sqrt(np.sum(v * v))
+    x[...] = oldval + h * v
+    fxph = f(x)
+    fxph = np.sum(fxph * df) if df is not None else fxph
+    x[...] = oldval - h * v
+    fxmh = f(x)
+    fxmh = np.sum(fxmh * df) if df is not None else fxmh
+    x[...] = oldval
+    numerical = (fxph - fxmh) / (2 * h)
+    analytic = np.sum(analytic_grad * v)
+    denom = abs(numerical) + abs(analytic)
+    rel_errors[i] = abs(numerical - analytic) / denom if denom > 0 else 0.0
+  return rel_errors
+
+
+def _parallel_numerical_gradient(f, x, df, h, n_jobs):
+  """
+  Compute the numeric gradient of f at x, or of np.sum(f(x) * df) if df is
+  not None, with the coordinates of x split into chunks over a pool of
+  forked worker processes.
+  """
+  grad = np.zeros_like(x)
+  grad.flat[:] = _numerical_partials(f, x, df, h, np.arange(x.size), n_jobs)
+  return grad
+
+
+def _numerical_partials(f, x, df, h, indices, n_jobs=1):
+  """
+  Return an array with the numeric partial derivatives of f, or of
+  np.sum(f(x) * df) if df is not None, for the flat indices of x in
+  indices. With n_jobs other than 1 the indices are split into chunks over
+  a pool of forked worker processes.
+  """
+  global _worker_state
+  if n_jobs < 0:
+    n_jobs = multiprocessing.cpu_count()
+  _worker_state = (f, x, df, h)
+  try:
+    if n_jobs == 1:
+      return _numerical_gradient_chunk(indices)
+    chunks = np.array_split(indices, 4 * n_jobs)
+    chunks = [chunk for chunk in chunks if chunk.size > 0]
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+      results = pool.map(_numerical_gradient_chunk, chunks)
+    finally:
+      pool.close()
+      pool.join()
+    return np.concatenate(results)
+  finally:
+    _worker_state = None
+
+
+# State shared with the forked workers of _numerical_partials; a tuple
+# (f, x, df, h).
+_worker_state = None
+
+
+def _numerical_gradient_chunk(indices):
+  """
+  Return the partial derivatives for the flat indices of x in indices. Each
+  worker has its own copy of x, so perturbing it here is safe; x is always
+  restored before returning.
+  """
+  f, x, df, h = _worker_state
+  result = np.zeros(indices.size)
+  for j, i in enumerate(indices):
+    ix = np.unravel_index(i, x.shape)
+    oldval = x[ix]
+    x[ix] = oldval + h
+    pos = np.copy(f(x))
+    x[ix] = oldval - h
+    neg = np.copy(f(x))
+    x[ix] = oldval
+    if df is None:
+      result[j] = (pos - neg) / (2 * h)
+    else:
+      result[j] = np.sum((pos - neg) * df) / (2 * h)
+  return result
+
+
 def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
   """
   sample a few random elements and only return numerical
@@ -122,3 +282,163 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
     rel_error = abs(grad_numerical - grad_analytic) / (abs(grad_numerical) + abs(grad_analytic))
     print 'numerical: %f analytic: %f, relative error: %e' % (grad_numerical, grad_analytic, rel_error)
 
+
+class GradientChecker(object):
+  """
+  Checks an analytic gradient of a function f at x against numeric partial
+  derivatives at sampled coordinates, and returns a report instead of
+  printing. This is a structured version of grad_check_sparse. As with
+  eval_numerical_gradient_array, a function with array output is checked
+  through np.sum(f(x) * df) for an upstream gradient df, so layers can be
+  checked directly.
+
+  Coordinates are sampled without replacement with probability proportional
+  to a mix of the analytic gradient magnitude and a uniform distribution, so
+  the entries that matter most are checked first but every entry can be
+  picked. They are checked batch_size at a time, optionally in a pool of
+  worker processes, and checking stops as soon as one coordinate fails.
+
+  With max_fail_rate > 0, checking may also stop early once enough
+  coordinates have passed to bound the failure rate: after n passing
+  coordinates, a fraction of failing coordinates above max_fail_rate would
+  have gone unseen with probability at most (1 - max_fail_rate) ** n, and
+  checking stops once that is below 1 - confidence. Such a check is reported
+  as confident but not as passed, since it skipped coordinates it was allowed
+  to check. Early stopping is never used when max_checks covers all of x.
+
+  Every numeric partial derivative is cached, and the cache is kept as long
+  as f, h, x and df are unchanged, so repeated checks on the same model only
+  evaluate coordinates that were not checked before.
+
+  Example usage:
+
+  checker = GradientChecker(lambda W: svm_loss_naive(W, X, y, 0.0)[0], W)
+  report = checker.check(grad)
+  assert report['passed'], report['max_rel_error']
+
+  out, cache = affine_forward(x, w, b)
+  dx, dw, db = affine_backward(dout, cache)
+  checker = GradientChecker(lambda x: affine_forward(x, w, b)[0], x, dout)
+  report = checker.check(dx)
+  """
+
+  def __init__(self, f, x, df=None, h=1e-5, n_jobs=1, seed=0):
+    """
+    Inputs:
+    - f: Function taking x and returning a scalar, or an array if df is given.
+    - x: Numpy array at which gradients are checked. It is perturbed in
+      place while f is evaluated and restored afterwards.
+    - df: Optional upstream gradient with the shape of f(x).
+    - h: Step size of the centered differences.
+    - n_jobs: Number of worker processes used to evaluate each batch of
+      coordinates; -1 uses every core.
+    - seed: Seed for sampling coordinates.
+    """
+    self.f = f
+    self.x = x
+    self.df = df
+    self.h = h
+    self.n_jobs = n_jobs
+    self.rng = np.random.RandomState(seed)
+    self._fingerprint = None
+    self._cached_f = None
+    self._partials = {}
+
+  def check(self, analytic_grad, tol=1e-6, max_checks=100, batch_size=10,
+            confidence=0.95, max_fail_rate=0.0, uniform_weight=0.5):
+    """
+    Check analytic_grad against numeric partial derivatives.
+
+    Inputs:
+    - analytic_grad: The gradient to check, with the shape of x.
+    - tol: A coordinate fails if its relative error is above tol.
+    - max_checks: Maximum number of coordinates to check.
+    - batch_size: Number of coordinates evaluated between stopping checks.
+    - confidence, max_fail_rate: If max_fail_rate > 0, stop once the
+      coordinates checked so far show with this confidence that at most
+      max_fail_rate of the coordinates fail; see the class docstring.
+      The default of 0 checks all max_checks coordinates.
+    - uniform_weight: Weight of the uniform distribution in the mix that
+      coordinates are sampled from; 1 samples uniformly.
+
+    Returns:
+    A dictionary with keys:
+    - passed: True if all max_checks coordinates (or every coordinate of x,
+      if there are fewer) were checked and had a relative error below tol.
+    - confident: True if checking stopped early because the confidence bound
+      was met; passed is then False.
+    - num_checks: Number of coordinates checked.
+    - num_evals: Number of calls to f made by this check; cached values cost
+      nothing.
+    - indices: List of the checked coordinates as index tuples, in order.
+    - numerical, analytic, rel_errors: Arrays of shape (num_checks,).
+    - max_rel_error, mean_rel_error: Summaries of rel_errors.
+    """
+    self._validate_cache()
+    analytic_grad = np.asarray(analytic_grad)
+    magnitude = np.abs(analytic_grad).ravel().astype(np.float64)
+    total = magnitude.sum()
+    p = np.ones(magnitude.size) / magnitude.size
+    if total > 0:
+      p = uniform_weight * p + (1 - uniform_weight) * magnitude / total
+    max_checks = min(max_checks, magnitude.size)
+    order = self.rng.choice(magnitude.size, max_checks, replace=False, p=p)
+
+    needed = max_checks
+    if max_fail_rate > 0 and max_checks < magnitude.size:
+      needed = int(math.ceil(math.log(1 - confidence) /
+                             math.log(1 - max_fail_rate)))
+    num_evals = 0
+    rel_errors = []
+    confident = False
+    for start in xrange(0, max_checks, batch_size):
+      batch = order[start:start + batch_size]
+      missing = np.array([i for i in batch if i not in self._partials],
+                         dtype=np.intp)
+      if missing.size > 0:
+        values = _numerical_partials(self.f, self.x, self.df, self.h, missing,
+                                     self.n_jobs)
+        self._partials.update(zip(missing.tolist(), values))
+        num_evals += 2 * missing.size
+      for i in batch:
+        numerical = self._partials[i]
+        analytic = analytic_grad.flat[i]
+        denom = abs(numerical) + abs(analytic)
+        rel_errors.append(abs(numerical - analytic) / denom if denom > 0 else 0.0)
+      if max(rel_errors) > tol:
+        break
+      if len(rel_errors) >= needed and len(rel_errors) < max_checks:
+        confident = True
+        break
+
+    num_checks = len(rel_errors)
+    checked = order[:num_checks]
+    rel_errors = np.array(rel_errors)
+    return {
+      'passed': num_checks == max_checks and bool(np.all(rel_errors <= tol)),
+      'confident': confident,
+      'num_checks': num_checks,
+      'num_evals': num_evals,
+      'indices': [np.unravel_index(i, self.x.shape) for i in checked],
+      'numerical': np.array([self._partials[i] for i in checked]),
+      'analytic': analytic_grad.ravel()[checked],
+      'rel_errors': rel_errors,
+      'max_rel_error': rel_errors.max(),
+      'mean_rel_error': rel_errors.mean(),
+    }
+
+  def _validate_cache(self):
+    """
+    Drop the cached values if f, h, x or df has changed since they were
+    computed.
+    """
+    sha = hashlib.sha1(repr(self.h))
+    sha.update(np.ascontiguousarray(self.x).view(np.uint8))
+    if self.df is not None:
+      sha.update(np.ascontiguousarray(self.df).view(np.uint8))
+    fingerprint = sha.hexdigest()
+    if fingerprint != self._fingerprint or self.f is not self._cached_f:
+      self._fingerprint = fingerprint
+      self._cached_f = self.f
+      self._partials = {}
+
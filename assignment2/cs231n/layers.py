@@ -454,14 +454,15 @@ def conv_forward_naive(x, w, b, conv_param):
     #############################################################################
     N, C, H, W = x.shape
     F, C, HH, WW = w.shape
+    pad = conv_param['pad']
 
-    H_conv = 1 + (H + 2 * conv_param['pad'] - HH) / conv_param['stride']
-    W_conv = 1 + (W + 2 * conv_param['pad'] - WW) / conv_param['stride']
+    H_conv = 1 + (H + 2 * pad - HH) / conv_param['stride']
+    W_conv = 1 + (W + 2 * pad - WW) / conv_param['stride']
     conv_shape = (N, F, H_conv, W_conv)
     out = np.zeros(np.prod(conv_shape)).reshape(conv_shape)
 
     for i in range(N):
-        pad_x = np.pad(x[i], [(0, 0), (1, 1), (1, 1)], 'constant', constant_values=0)
+        pad_x = np.pad(x[i], [(0, 0), (pad, pad), (pad, pad)], 'constant', constant_values=0)
         for j in range(F):
             fltr = w[j]
             for ih in range(H_conv):
@@ -498,10 +499,11 @@ def conv_backward_naive(dout, cache):
     x, w, b, conv_param = cache
     N, C, H, W = x.shape
     F, C, HH, WW = w.shape
-    H_conv = 1 + (H + 2 * conv_param['pad'] - HH) / conv_param['stride']
-    W_conv = 1 + (W + 2 * conv_param['pad'] - WW) / conv_param['stride']
+    pad = conv_param['pad']
+    H_conv = 1 + (H + 2 * pad - HH) / conv_param['stride']
+    W_conv = 1 + (W + 2 * pad - WW) / conv_param['stride']
 
-    pad_x = np.pad(x, [(0, 0), (0, 0), (1, 1), (1, 1)], 'constant', constant_values=0)
+    pad_x = np.pad(x, [(0, 0), (0, 0), (pad, pad), (pad, pad)], 'constant', constant_values=0)
     dpadx = np.zeros(np.prod(pad_x.shape)).reshape(pad_x.shape)
     dw = np.zeros(np.prod(w.shape)).reshape(w.shape)
     db = np.zeros(np.prod(b.shape)).reshape(b.shape)
@@ -517,7 +519,7 @@ def conv_backward_naive(dout, cache):
                     dpadx[n, :, cur_h:cur_h + HH, cur_w:cur_w + WW] += dout_cell * w[f]
                     db[f] += dout_cell
 
-    dx = dpadx[:, :, conv_param['pad']:-conv_param['pad'], conv_param['pad']:-conv_param['pad']]
+    dx = dpadx[:, :, pad:pad + H, pad:pad + W]
 
     #############################################################################
     #                             END OF YOUR CODE                              #
@@ -1,9 +1,17 @@
+import multiprocessing
+import os
+import resource
+import time
+import traceback
 import numpy as np
 try:
   from cs231n.im2col_cython import col2im_cython, im2col_cython
   from cs231n.im2col_cython import col2im_6d_cython
+  HAS_CYTHON = True
 except ImportError:
-  print 'run the following from the cs231n directory and try again:'
+  HAS_CYTHON = False
+  print 'The Cython extension is not built; convolutions fall back to numpy.'
+  print 'For the fast version, run the following from the cs231n directory:'
   print 'python setup.py build_ext --inplace'
   print 'You may also need to restart your iPython kernel'
 
@@ -83,7 +91,14 @@ def conv_forward_strides(x, w, b, conv_param):
   return out, cache
   
 
-def conv_backward_strides(dout, cache):
+def conv_backward_strides(dout, cache, col2im_6d=None):
+  """
+  Backward pass for conv_forward_strides. col2im_6d is the function used to
+  scatter the column gradients back to the input; it defaults to the Cython
+  version if it is built and to col2im_6d_numpy otherwise.
+  """
+  if col2im_6d is None:
+    col2im_6d = col2im_6d_cython if HAS_CYTHON else col2im_6d_numpy
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
 
@@ -98,11 +113,354 @@ def conv_backward_strides(dout, cache):
 
   dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
   dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-  dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+  dx = col2im_6d(dx_cols, N, C, H, W, HH, WW, pad, stride)
+
+  return dx, dw, db
+
+
+def col2im_6d_numpy(cols, N, C, H, W, HH, WW, pad, stride):
+  """
+  A pure numpy version of col2im_6d_cython: sum the columns of shape
+  (C, HH, WW, N, out_h, out_w) back into an array of shape (N, C, H, W).
+
+  Instead of scattering every element with np.add.at, this loops over the
+  HH * WW filter offsets and adds each one as a single strided slice, since
+  for a fixed offset no two output positions touch the same input pixel.
+  """
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      x_padded[:, :, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += \
+        cols[:, i, j].transpose(1, 0, 2, 3)
+  return x_padded[:, :, pad:pad + H, pad:pad + W]
+
+
+def conv_backward_strides_numpy(dout, cache):
+  """
+  Backward pass for conv_forward_strides that only uses numpy.
+  """
+  return conv_backward_strides(dout, cache, col2im_6d=col2im_6d_numpy)
+
+
+# Default size in bytes of the column workspace used by conv_forward_tiled;
+# conv_param['workspace_bytes'] overrides it for a single layer.
+CONV_WORKSPACE_BYTES = 32 * 1024 ** 2
+
+# The workspace itself, shared by every call and grown only when needed.
+_conv_workspace = {'buffer': None}
+
+
+def conv_forward_tiled(x, w, b, conv_param):
+  """
+  A memory-lean implementation of the forward pass for a convolutional layer.
+
+  Like conv_forward_strides this turns the convolution into a matrix multiply
+  over columns of input patches, but it never pads the input or builds the
+  column matrix for the whole batch. Instead it processes as many images at
+  a time as fit in a column workspace of conv_param.get('workspace_bytes',
+  CONV_WORKSPACE_BYTES) bytes, which is reused across tiles and calls; the
+  zero padding is written only into the border entries of the workspace.
+  The cache holds no columns, so the backward pass rebuilds them tile by
+  tile in the same workspace.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  w_rows = w.reshape(F, -1)
+
+  out = np.empty((N, F, out_h, out_w), dtype=np.result_type(x.dtype, w.dtype))
+  for n0, n1, cols in _conv_tiles(x, HH, WW, pad, stride, conv_param):
+    res = w_rows.dot(cols.reshape(C * HH * WW, -1))
+    res += b.reshape(-1, 1)
+    out[n0:n1] = res.reshape(F, n1 - n0, out_h, out_w).transpose(1, 0, 2, 3)
+
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+def conv_backward_tiled(dout, cache):
+  """
+  Backward pass for conv_forward_tiled.
+  """
+  x, w, b, conv_param = cache
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  w_rows = w.reshape(F, -1)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+  dw = np.empty((F, C * HH * WW), dtype=np.result_type(dout.dtype, x.dtype))
+  dx = np.zeros(x.shape, dtype=np.result_type(dout.dtype, w.dtype))
+  for n0, n1, cols in _conv_tiles(x, HH, WW, pad, stride, conv_param):
+    cols_2d = cols.reshape(C * HH * WW, -1)
+    dout_rows = dout[n0:n1].transpose(1, 0, 2, 3).reshape(F, -1)
+    if n0 == 0:
+      np.dot(dout_rows, cols_2d.T, out=dw)
+    else:
+      dw += dout_rows.dot(cols_2d.T)
+    # The columns are no longer needed, so their gradient overwrites them
+    if cols.dtype == np.result_type(w.dtype, dout.dtype):
+      np.dot(w_rows.T, dout_rows, out=cols_2d)
+    else:
+      cols_2d[...] = w_rows.T.dot(dout_rows)
+    _col2im_tile(cols, dx[n0:n1], pad, stride)
+
+  return dx, dw.reshape(w.shape), db
+
+
+def _conv_tiles(x, HH, WW, pad, stride, conv_param):
+  """
+  Yield (n0, n1, cols) for consecutive tiles of images x[n0:n1], where cols
+  is a view of shape (C, HH, WW, n1 - n0, out_h, out_w) into the shared
+  workspace holding the im2col columns of the tile. cols is only valid until
+  the next tile is requested.
+  """
+  N, C, H, W = x.shape
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  workspace_bytes = conv_param.get('workspace_bytes', CONV_WORKSPACE_BYTES)
+  image_size = C * HH * WW * out_h * out_w
+  tile = int(max(1, min(N, workspace_bytes // (image_size * x.dtype.itemsize))))
+  buf = _get_conv_workspace(tile * image_size, x.dtype)
+  for n0 in xrange(0, N, tile):
+    n1 = min(n0 + tile, N)
+    cols = buf[:(n1 - n0) * image_size].reshape(C, HH, WW, n1 - n0, out_h, out_w)
+    for i in xrange(HH):
+      h0, h1, x_rows = _valid_positions(i, H, out_h, pad, stride)
+      for j in xrange(WW):
+        w0, w1, x_cols = _valid_positions(j, W, out_w, pad, stride)
+        dst = cols[:, i, j]
+        # Zero only the borders where the filter hangs over the padding
+        dst[:, :, :h0] = 0
+        dst[:, :, h1:] = 0
+        dst[:, :, h0:h1, :w0] = 0
+        dst[:, :, h0:h1, w1:] = 0
+        dst[:, :, h0:h1, w0:w1] = x[n0:n1, :, x_rows, x_cols].transpose(1, 0, 2, 3)
+    yield n0, n1, cols
+
+
+def _col2im_tile(cols, dx, pad, stride):
+  """
+  Add the column gradients cols of shape (C, HH, WW, n, out_h, out_w) into
+  dx of shape (n, C, H, W), skipping the entries that fall on the padding.
+  """
+  C, HH, WW, n, out_h, out_w = cols.shape
+  H, W = dx.shape[2:]
+  for i in xrange(HH):
+    h0, h1, x_rows = _valid_positions(i, H, out_h, pad, stride)
+    for j in xrange(WW):
+      w0, w1, x_cols = _valid_positions(j, W, out_w, pad, stride)
+      dx[:, :, x_rows, x_cols] += cols[:, i, j, :, h0:h1, w0:w1].transpose(1, 0, 2, 3)
+
+
+def _valid_positions(offset, size, out_size, pad, stride):
+  """
+  For a filter offset along one axis, return (o0, o1, input_slice) where
+  outputs o0:o1 are the ones that read inside the unpadded input, at the
+  input positions given by input_slice.
+  """
+  o0 = min(out_size, max(0, -(-(pad - offset) // stride)))
+  o1 = max(o0, min(out_size, (size - 1 + pad - offset) // stride + 1))
+  start = o0 * stride + offset - pad
+  return o0, o1, slice(start, start + (o1 - o0 - 1) * stride + 1, stride)
+
+
+def _get_conv_workspace(size, dtype):
+  """
+  Return a flat array of at least size elements of dtype from the shared
+  workspace, reallocating it only if it is too small or of another dtype.
+  """
+  buf = _conv_workspace['buffer']
+  if buf is None or buf.dtype != dtype or buf.size < size:
+    buf = _conv_workspace['buffer'] = np.empty(size, dtype=dtype)
+  return buf
+
+
+# Transforms of the Winograd algorithm F(2x2, 3x3) (Lavin and Gray, 2015),
+# written as Kronecker products so that transforming a batch of 4x4 input
+# tiles, 3x3 filters or 4x4 output tiles is a single matrix multiply on the
+# flattened tiles.
+_WINOGRAD_BT = np.array([[1, 0, -1, 0], [0, 1, 1, 0], [0, -1, 1, 0],
+                         [0, 1, 0, -1]], dtype=np.float64)
+_WINOGRAD_G = np.array([[1, 0, 0], [0.5, 0.5, 0.5], [0.5, -0.5, 0.5],
+                        [0, 0, 1]], dtype=np.float64)
+_WINOGRAD_AT = np.array([[1, 1, 1, 0], [0, 1, -1, -1]], dtype=np.float64)
+_WINOGRAD_INPUT = np.kron(_WINOGRAD_BT, _WINOGRAD_BT)
+_WINOGRAD_FILTER = np.kron(_WINOGRAD_G, _WINOGRAD_G)
+_WINOGRAD_OUTPUT = np.kron(_WINOGRAD_AT, _WINOGRAD_AT)
+
+
+def winograd_applicable(w_shape, conv_param):
+  """
+  Return True if conv_forward_winograd can handle filters of shape w_shape
+  with this conv_param: 3x3 filters, stride 1 and a padding of at most 2.
+  """
+  return (tuple(w_shape[2:]) == (3, 3) and conv_param['stride'] == 1
+          and conv_param['pad'] <= 2)
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  Forward pass for a 3x3, stride 1 convolutional layer using the Winograd
+  algorithm F(2x2, 3x3). Each 2x2 block of outputs is computed from a 4x4
+  input tile with 16 multiplies per channel instead of 36, and the channel
+  sums become 16 independent matrix multiplies.
+  """
+  if not winograd_applicable(w.shape, conv_param):
+    raise ValueError('Winograd convolution needs 3x3 filters, stride 1 and '
+                     'pad <= 2')
+  out = _winograd_conv(x, w, conv_param['pad'])
+  out += b.reshape(1, -1, 1, 1)
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+  """
+  Backward pass for conv_forward_winograd. The input gradient is itself a
+  3x3 stride 1 convolution of dout with the flipped filters, so it also uses
+  the Winograd algorithm; the filter gradient is a sum of nine matrix
+  multiplies, one per filter offset.
+  """
+  x, w, b, conv_param = cache
+  pad = conv_param['pad']
+  N, C, H, W = x.shape
+  _, _, out_h, out_w = dout.shape
+
+  db = np.sum(dout, axis=(0, 2, 3)).astype(x.dtype, copy=False)
+  dx = _winograd_conv(dout.astype(x.dtype, copy=False),
+                      w[:, :, ::-1, ::-1].transpose(1, 0, 2, 3), 2 - pad)
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  dw = np.empty(w.shape, dtype=x.dtype)
+  for i in xrange(3):
+    for j in xrange(3):
+      window = x_padded[:, :, i:i + out_h, j:j + out_w]
+      dw[:, :, i, j] = np.tensordot(dout, window, axes=([0, 2, 3], [0, 2, 3]))
 
   return dx, dw, db
 
 
+def _winograd_conv(x, w, pad):
+  """
+  Return the stride 1 convolution of x of shape (N, C, H, W) with 3x3 filters
+  w of shape (F, C, 3, 3) and zero padding pad, without a bias. The result
+  has the dtype of x.
+  """
+  N, C, H, W = x.shape
+  F = w.shape[0]
+  out_h, out_w = H + 2 * pad - 2, W + 2 * pad - 2
+  tiles_h, tiles_w = (out_h + 1) / 2, (out_w + 1) / 2
+  num_tiles = N * tiles_h * tiles_w
+
+  # Pad on all sides, plus one extra row or column at the end if needed so
+  # the input tiles cover a whole number of 2x2 output blocks
+  x_padded = np.zeros((N, C, 2 * tiles_h + 2, 2 * tiles_w + 2), dtype=x.dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  s0, s1, s2, s3 = x_padded.strides
+  tiles = np.lib.stride_tricks.as_strided(
+      x_padded, shape=(N, C, tiles_h, tiles_w, 4, 4),
+      strides=(s0, s1, 2 * s2, 2 * s3, s2, s3))
+  tiles = tiles.transpose(4, 5, 1, 0, 2, 3).reshape(16, -1)
+
+  # Transform in the dtype of x, so float32 layers stay in float32
+  dtype = x.dtype
+  w = w.astype(dtype, copy=False)
+  V = _WINOGRAD_INPUT.astype(dtype).dot(tiles).reshape(16, C, num_tiles)
+  U = _WINOGRAD_FILTER.astype(dtype).dot(w.reshape(F * C, 9).T)
+  U = U.reshape(16, F, C)
+  M = np.empty((16, F, num_tiles), dtype=dtype)
+  for k in xrange(16):
+    np.dot(U[k], V[k], out=M[k])
+  Y = _WINOGRAD_OUTPUT.astype(dtype).dot(M.reshape(16, -1))
+
+  Y = Y.reshape(2, 2, F, N, tiles_h, tiles_w).transpose(3, 2, 4, 0, 5, 1)
+  Y = Y.reshape(N, F, 2 * tiles_h, 2 * tiles_w)
+  return np.ascontiguousarray(Y[:, :, :out_h, :out_w])
+
+
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer computed with FFTs: in the
+  frequency domain the correlation of each image with each filter is a
+  pointwise product, and the sum over channels is one matrix multiply per
+  frequency. The cost does not depend on the filter size, so this pays off
+  for large filters. Strides larger than 1 are handled by subsampling the
+  stride 1 result. The FFTs are computed in double precision, and the
+  outputs are cast back to the dtype of x.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  size = (H + 2 * pad, W + 2 * pad)
+  out_h = (size[0] - HH) / stride + 1
+  out_w = (size[1] - WW) / stride + 1
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  x_freq = np.fft.rfft2(x_padded)
+  w_freq = np.fft.rfft2(w, s=size)
+  # out_freq[n, f] = sum_c x_freq[n, c] * conj(w_freq[f, c])
+  out_freq = _sum_over_channels(x_freq, np.conj(w_freq).transpose(1, 0, 2, 3))
+  out = np.fft.irfft2(out_freq, s=size)
+  out = out[:, :, :stride * (out_h - 1) + 1:stride, :stride * (out_w - 1) + 1:stride]
+  out = np.ascontiguousarray(out, dtype=x.dtype)
+  out += b.reshape(1, -1, 1, 1)
+
+  cache = (x, w, b, conv_param, x_freq, w_freq)
+  return out, cache
+
+
+def conv_backward_fft(dout, cache):
+  """
+  Backward pass for conv_forward_fft, reusing the transforms of the input and
+  filters from the forward pass.
+  """
+  x, w, b, conv_param, x_freq, w_freq = cache
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  size = (H + 2 * pad, W + 2 * pad)
+  _, _, out_h, out_w = dout.shape
+
+  db = np.sum(dout, axis=(0, 2, 3)).astype(x.dtype, copy=False)
+
+  # Spread dout over the stride 1 output grid, where it is zero in between
+  dout_full = np.zeros((N, F, size[0], size[1]), dtype=dout.dtype)
+  dout_full[:, :, :stride * (out_h - 1) + 1:stride,
+            :stride * (out_w - 1) + 1:stride] = dout
+  dout_freq = np.fft.rfft2(dout_full)
+
+  # dx is the full convolution of dout with the filters
+  dx_padded = np.fft.irfft2(_sum_over_channels(dout_freq, w_freq), s=size)
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  # dw[f, c] is the correlation of the padded input with dout
+  dw_freq = _sum_over_channels(np.conj(dout_freq).transpose(1, 0, 2, 3),
+                               x_freq)
+  dw = np.fft.irfft2(dw_freq, s=size)[:, :, :HH, :WW]
+
+  dx = np.ascontiguousarray(dx, dtype=x.dtype)
+  dw = np.ascontiguousarray(dw, dtype=x.dtype)
+  return dx, dw, db
+
+
+def _sum_over_channels(a, b):
+  """
+  Given a of shape (N, C, K1, K2) and b of shape (C, F, K1, K2), return the
+  array of shape (N, F, K1, K2) with out[n, f] = sum_c a[n, c] * b[c, f],
+  computed as one matrix multiply per frequency.
+  """
+  N, C, K1, K2 = a.shape
+  F = b.shape[1]
+  a_k = np.ascontiguousarray(a.reshape(N, C, -1).transpose(2, 0, 1))
+  b_k = np.ascontiguousarray(b.reshape(C, F, -1).transpose(2, 0, 1))
+  return np.matmul(a_k, b_k).transpose(1, 2, 0).reshape(N, F, K1, K2)
+
+
 def conv_backward_im2col(dout, cache):
   """
   A fast implementation of the backward pass for a convolutional layer
@@ -125,8 +483,142 @@ def conv_backward_im2col(dout, cache):
   return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+# Convolution backends as (forward, backward) pairs. CONV_BACKEND names the
+# one conv_forward_fast uses; it is the fastest of cython, numpy and naive
+# that is available when this module is imported, and can be changed with
+# set_conv_backend. 'tiled' trades a little speed for much less memory, and
+# 'winograd' and 'fft' suit 3x3 and large filters; a layer can also pick a
+# backend, or 'auto', with conv_param['backend'].
+CONV_BACKENDS = {}
+if HAS_CYTHON:
+  CONV_BACKENDS['cython'] = (conv_forward_strides, conv_backward_strides)
+CONV_BACKENDS['numpy'] = (conv_forward_strides, conv_backward_strides_numpy)
+CONV_BACKENDS['tiled'] = (conv_forward_tiled, conv_backward_tiled)
+CONV_BACKENDS['winograd'] = (conv_forward_winograd, conv_backward_winograd)
+CONV_BACKENDS['fft'] = (conv_forward_fft, conv_backward_fft)
+CONV_BACKEND = [name for name in ('cython', 'numpy')
+                if name in CONV_BACKENDS][0]
+
+
+def set_conv_backend(name):
+  """
+  Select the convolution backend used by conv_forward_fast: one of the keys
+  of CONV_BACKENDS.
+  """
+  global CONV_BACKEND
+  if name not in CONV_BACKENDS:
+    raise ValueError('Unknown or unavailable conv backend "%s"' % name)
+  CONV_BACKEND = name
+
+
+def conv_forward_fast(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer, using
+  the backend named by conv_param['backend'] if it is given and CONV_BACKEND
+  otherwise. If the backend is 'auto', choose_conv_backend picks the fastest
+  one for the shape of this layer. The cache records the backend, so
+  conv_backward_fast uses the matching backward pass.
+  """
+  backend = conv_param.get('backend', CONV_BACKEND)
+  if backend == 'auto':
+    backend = choose_conv_backend(x, w, conv_param)
+  forward, _ = CONV_BACKENDS[backend]
+  out, cache = forward(x, w, b, conv_param)
+  return out, (backend, cache)
+
+
+def conv_backward_fast(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer.
+  """
+  backend, real_cache = cache
+  _, backward = CONV_BACKENDS[backend]
+  return backward(dout, real_cache)
+
+
+def benchmark_conv_memory(layers=None, backends=None, num_repeats=3,
+                          verbose=True):
+  """
+  Compare the peak memory and time of a forward and backward pass through
+  convolutional layers for several backends.
+
+  Each measurement runs in a forked child process, so the peak memory is the
+  growth of the child's resident set over the pass and does not depend on
+  earlier measurements. This uses os.fork and /proc, so it only works on
+  Linux. The im2col_cython kernels run on one thread in a forked child.
+
+  Inputs:
+  - layers: List of tuples (N, C, H, W, F, HH, stride, pad) describing the
+    input, filters and conv_param of each layer. Defaults to layers shaped
+    like those of PretrainedCNN on a batch of 32 images.
+  - backends: List of keys of CONV_BACKENDS to compare; defaults to the
+    default backend and 'tiled'.
+  - num_repeats: The best time over this many passes is reported.
+  - verbose: Boolean; if true, print one line per layer and backend.
+
+  Returns:
+  A list of dictionaries with keys 'layer', 'backend', 'seconds' and
+  'peak_bytes'.
+  """
+  if layers is None:
+    layers = [(32, 3, 64, 64, 64, 5, 1, 2), (32, 64, 32, 32, 64, 3, 1, 1),
+              (32, 128, 16, 16, 128, 3, 1, 1), (32, 256, 8, 8, 256, 3, 1, 1),
+              (32, 512, 4, 4, 1024, 3, 1, 1)]
+  if backends is None:
+    backends = [CONV_BACKEND, 'tiled']
+  results = []
+  for layer in layers:
+    N, C, H, W, F, HH, stride, pad = layer
+    x = np.random.randn(N, C, H, W)
+    w = np.random.randn(F, C, HH, HH)
+    b = np.random.randn(F)
+    conv_param = {'stride': stride, 'pad': pad}
+    for backend in backends:
+      forward, backward = CONV_BACKENDS[backend]
+      def run():
+        out, cache = forward(x, w, b, conv_param)
+        backward(out, cache)
+      seconds = min(_run_in_child(run)[0] for _ in xrange(num_repeats))
+      peak_bytes = _run_in_child(run)[1]
+      results.append({'layer': layer, 'backend': backend, 'seconds': seconds,
+                      'peak_bytes': peak_bytes})
+      if verbose:
+        print '%-36s %-7s %8.4f s  peak %8.1f MB' % (
+            layer, backend, seconds, peak_bytes / 1024.0 ** 2)
+  return results
+
+
+def _run_in_child(fn):
+  """
+  Call fn in a forked child process and return (seconds, peak_bytes), where
+  peak_bytes is how far the child's resident set grew above its size at the
+  start of the call.
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    status = 1
+    try:
+      os.close(read_fd)
+      with open('/proc/self/statm') as f:
+        start_rss = int(f.read().split()[1]) * resource.getpagesize()
+      tic = time.time()
+      fn()
+      seconds = time.time() - tic
+      peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+      os.write(write_fd, '%r %d' % (seconds, max(0, peak_rss - start_rss)))
+      status = 0
+    except Exception:
+      traceback.print_exc()
+    finally:
+      os._exit(status)
+  os.close(write_fd)
+  with os.fdopen(read_fd) as f:
+    result = f.read()
+  if os.waitpid(pid, 0)[1] != 0:
+    raise RuntimeError('The benchmarked function failed in the child process')
+  seconds, peak_bytes = result.split()
+  return float(seconds), int(peak_bytes)
 
 
 def max_pool_forward_fast(x, pool_param):
@@ -268,3 +760,167 @@ def max_pool_backward_im2col(dout, cache):
   dx = dx.reshape(x.shape)
 
   return dx
+
+
+# Backend chosen by choose_conv_backend for each layer shape, keyed by
+# (x.shape, w.shape, stride, pad, dtype).
+_CONV_CHOICES = {}
+
+
+def choose_conv_backend(x, w, conv_param, candidates=None):
+  """
+  Return the fastest backend for a layer with input x, filters w and this
+  conv_param. The first time a shape is seen, every applicable candidate is
+  timed on one forward and backward pass over x and w; the winner is
+  remembered, so later calls with the same shape cost nothing.
+
+  Inputs:
+  - x, w, conv_param: As for conv_forward_fast.
+  - candidates: Backends to consider; defaults to CONV_BACKEND, 'fft' and,
+    for 3x3 stride 1 layers, 'winograd'.
+
+  Returns:
+  The name of the chosen backend.
+  """
+  key = (x.shape, w.shape, conv_param['stride'], conv_param['pad'], x.dtype.str)
+  if key not in _CONV_CHOICES:
+    times = _time_conv_backends(x, w, conv_param, candidates, num_repeats=1)
+    _CONV_CHOICES[key] = min(times, key=times.get)
+  return _CONV_CHOICES[key]
+
+
+def benchmark_conv_backends(layers=None, candidates=None, num_repeats=3,
+                            verbose=True):
+  """
+  Time a forward and backward pass of every applicable backend on a list of
+  layer shapes, to show where the Winograd and FFT backends overtake im2col.
+
+  Inputs:
+  - layers: List of tuples (N, C, H, W, F, HH, stride, pad). Defaults to the
+    3x3 layers of PretrainedCNN and the 7x7 layer of ThreeLayerConvNet.
+  - candidates: Backends to compare; see choose_conv_backend.
+  - num_repeats: The best time over this many passes is reported.
+  - verbose: Boolean; if true, print the times of each layer and the winner.
+
+  Returns:
+  A list with one dictionary per layer mapping backend names to seconds.
+  """
+  if layers is None:
+    layers = [(32, 3, 32, 32, 32, 7, 1, 3), (32, 64, 32, 32, 64, 3, 1, 1),
+              (32, 128, 16, 16, 128, 3, 1, 1), (32, 256, 8, 8, 256, 3, 1, 1),
+              (32, 512, 4, 4, 512, 3, 1, 1)]
+  results = []
+  for N, C, H, W, F, HH, stride, pad in layers:
+    x = np.random.randn(N, C, H, W)
+    w = np.random.randn(F, C, HH, HH)
+    conv_param = {'stride': stride, 'pad': pad}
+    times = _time_conv_backends(x, w, conv_param, candidates, num_repeats)
+    results.append(times)
+    if verbose:
+      print '%-36s %s  best: %s' % (
+          (N, C, H, W, F, HH, stride, pad),
+          '  '.join('%s %.4f s' % item for item in sorted(times.items())),
+          min(times, key=times.get))
+  return results
+
+
+def _time_conv_backends(x, w, conv_param, candidates, num_repeats):
+  """
+  Return a dictionary mapping each candidate backend that supports the layer
+  to its best time over num_repeats forward and backward passes.
+  """
+  if candidates is None:
+    candidates = [CONV_BACKEND, 'fft', 'winograd']
+  b = np.zeros(w.shape[0], dtype=w.dtype)
+  times = {}
+  for name in candidates:
+    if name not in CONV_BACKENDS or name in times:
+      continue
+    if name == 'winograd' and not winograd_applicable(w.shape, conv_param):
+      continue
+    forward, backward = CONV_BACKENDS[name]
+    best = np.inf
+    for _ in xrange(num_repeats):
+      tic = time.time()
+      try:
+        out, cache = forward(x, w, b, conv_param)
+      except (AssertionError, ValueError):
+        # This backend does not support the shape
+        break
+      backward(out, cache)
+      best = min(best, time.time() - tic)
+    else:
+      times[name] = best
+  return times
+
+
+def benchmark_im2col_scaling(layers=None, max_threads=None, num_repeats=3,
+                             verbose=True):
+  """
+  Time the Cython im2col, col2im and col2im_6d kernels with 1 to max_threads
+  OpenMP threads, to show how they scale with the number of cores. The
+  kernels are left using their default number of threads afterwards.
+
+  Inputs:
+  - layers: List of tuples (N, C, H, W, HH, stride, pad) describing the input
+    and filter size of each layer. Defaults to layers shaped like those of
+    PretrainedCNN on a batch of 32 images.
+  - max_threads: Largest number of threads to try; defaults to the number of
+    cores.
+  - num_repeats: The best time over this many calls is reported.
+  - verbose: Boolean; if true, print one line per layer and thread count.
+
+  Returns:
+  A list of dictionaries with keys 'layer', 'threads', 'im2col', 'col2im' and
+  'col2im_6d' giving the seconds per call, and 'speedup' giving the speedup
+  of the three kernels together over one thread.
+  """
+  if not HAS_CYTHON:
+    raise ImportError('The im2col_cython extension is not built; run '
+                      'python setup.py build_ext --inplace in cs231n')
+  from cs231n.im2col_cython import set_num_threads
+  if layers is None:
+    layers = [(32, 3, 64, 64, 5, 1, 2), (32, 64, 32, 32, 3, 1, 1),
+              (32, 128, 16, 16, 3, 1, 1), (32, 256, 8, 8, 3, 1, 1)]
+  if max_threads is None:
+    max_threads = multiprocessing.cpu_count()
+
+  def best_time(fn, *args):
+    best = np.inf
+    for _ in xrange(num_repeats):
+      tic = time.time()
+      fn(*args)
+      best = min(best, time.time() - tic)
+    return best
+
+  results = []
+  try:
+    for layer in layers:
+      N, C, H, W, HH, stride, pad = layer
+      out_h = (H + 2 * pad - HH) / stride + 1
+      out_w = (W + 2 * pad - HH) / stride + 1
+      x = np.random.randn(N, C, H, W)
+      cols = np.random.randn(C * HH * HH, N * out_h * out_w)
+      cols_6d = np.random.randn(C, HH, HH, N, out_h, out_w)
+      baseline = None
+      for threads in xrange(1, max_threads + 1):
+        set_num_threads(threads)
+        r = {'layer': layer, 'threads': threads}
+        r['im2col'] = best_time(im2col_cython, x, HH, HH, pad, stride)
+        r['col2im'] = best_time(col2im_cython, cols, N, C, H, W, HH, HH, pad,
+                                stride)
+        r['col2im_6d'] = best_time(col2im_6d_cython, cols_6d, N, C, H, W, HH,
+                                   HH, pad, stride)
+        total = r['im2col'] + r['col2im'] + r['col2im_6d']
+        if baseline is None:
+          baseline = total
+        r['speedup'] = baseline / total
+        results.append(r)
+        if verbose:
+          print '%-28s %2d threads  im2col %.4f s  col2im %.4f s  ' \
+                'col2im_6d %.4f s  speedup %.2fx' % (
+                    layer, threads, r['im2col'], r['col2im'], r['col2im_6d'],
+                    r['speedup'])
+  finally:
+    set_num_threads(0)
+  return results
@@ -1,121 +1,261 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+import os
+import multiprocessing
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
 
+# The plain C types are used instead of np.float32_t and np.float64_t because
+# Cython cannot declare const memoryviews of the numpy typedefs.
 ctypedef fused DTYPE_t:
-    np.float32_t
-    np.float64_t
+    float
+    double
 
-def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
+# The kernels below release the GIL and split their outer loop over OpenMP
+# threads with prange. Each thread owns the rows of cols (im2col), or the
+# channels or image planes of x (col2im) that it writes, so no two threads
+# ever write the same element. Padding is handled by computing the range of
+# output positions that fall inside the input for each filter offset, so the
+# inner loops have no bounds checks and no padded copy of the input is made.
+# The inputs may have any strides, but are copied to C order first if they
+# are not already. If the extension is built without OpenMP the loops simply
+# run on one core.
+#
+# The OpenMP thread pool does not survive fork: a forked child that enters a
+# parallel region with more than one thread hangs. The kernels therefore run
+# on one thread in any process forked after this module was imported, such
+# as the workers of a multiprocessing.Pool.
+
+cdef extern from "pthread.h" nogil:
+    int pthread_atfork(void (*prepare)(), void (*parent)(), void (*child)())
+
+
+def _default_num_threads():
+    # OMP_NUM_THREADS may hold a list such as "4,2" for nested parallelism;
+    # only its first entry applies here. Anything unparsable falls back to
+    # the number of cores.
+    try:
+        num_threads = int(os.environ.get('OMP_NUM_THREADS', '').split(',')[0])
+    except ValueError:
+        return multiprocessing.cpu_count()
+    return num_threads if num_threads >= 1 else multiprocessing.cpu_count()
+
+
+# Number of threads used by the kernels; see set_num_threads.
+cdef int _num_threads = _default_num_threads()
+# Whether this process was forked after the module was imported.
+cdef bint _forked = False
+
+
+cdef void _after_fork() noexcept nogil:
+    global _num_threads, _forked
+    _num_threads = 1
+    _forked = True
+
+pthread_atfork(NULL, NULL, _after_fork)
+
+
+def set_num_threads(int num_threads):
+    """
+    Set the number of threads used by the im2col and col2im kernels; values
+    below 1 restore the default, which is OMP_NUM_THREADS if it is set and
+    the number of cores otherwise. In a forked child process the kernels
+    always use one thread.
+    """
+    global _num_threads
+    if num_threads < 1:
+        num_threads = _default_num_threads()
+    _num_threads = 1 if _forked else num_threads
+
+
+def get_num_threads():
+    """
+    Return the number of threads used by the im2col and col2im kernels.
+    """
+    return _num_threads
+
+
+cdef inline int _first_valid(int offset, int pad, int stride) noexcept nogil:
+    # Smallest output position o with stride * o + offset - pad >= 0
+    if offset >= pad:
+        return 0
+    return (pad - offset + stride - 1) / stride
+
+
+cdef inline int _end_valid(int offset, int pad, int stride, int size,
+                           int out_size) noexcept nogil:
+    # Smallest output position o with stride * o + offset - pad >= size,
+    # clipped to out_size
+    cdef int end = (size + pad - offset + stride - 1) / stride
+    if end > out_size:
+        return out_size
+    if end < 0:
+        return 0
+    return end
+
+
+def im2col_cython(const DTYPE_t[:, :, :, :] x, int field_height,
                   int field_width, int padding, int stride):
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
+
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
 
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
-            (C * field_height * field_width, N * HH * WW),
-            dtype=x.dtype)
-
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
+    cols = np.empty((C * field_height * field_width, N * HH * WW),
+                    dtype=np.asarray(x).dtype)
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef const DTYPE_t[:, :, :, ::1] x_c = np.ascontiguousarray(x)
 
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
+    im2col_cython_inner(cols_view, x_c, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
     return cols
 
 
-@cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
+cdef void im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                              const DTYPE_t[:, :, :, ::1] x,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) noexcept nogil:
+    cdef int row
+    for row in prange(C * field_height * field_width, schedule='static',
+                      num_threads=_num_threads):
+        _im2col_row(cols, x, row, N, H, W, HH, WW, field_height, field_width,
+                    padding, stride)
 
-    for c in range(C):
-        for yy in range(HH):
-            for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
 
+cdef void _im2col_row(DTYPE_t[:, ::1] cols, const DTYPE_t[:, :, :, ::1] x,
+                      int row, int N, int H, int W, int HH, int WW,
+                      int field_height, int field_width, int padding,
+                      int stride) noexcept nogil:
+    # Fill the row of cols for filter element (c, ii, jj) in memory order:
+    # the N images of column (yy, xx) are consecutive.
+    cdef int c = row / (field_height * field_width)
+    cdef int ii = (row / field_width) % field_height
+    cdef int jj = row % field_width
+    cdef int y_lo = _first_valid(ii, padding, stride)
+    cdef int y_hi = _end_valid(ii, padding, stride, H, HH)
+    cdef int x_lo = _first_valid(jj, padding, stride)
+    cdef int x_hi = _end_valid(jj, padding, stride, W, WW)
+    cdef int yy, xx, i, h, w, col
 
+    for col in range(N * WW * y_lo):
+        cols[row, col] = 0
+    for yy in range(y_lo, y_hi):
+        h = stride * yy + ii - padding
+        for col in range(yy * WW * N, (yy * WW + x_lo) * N):
+            cols[row, col] = 0
+        for xx in range(x_lo, x_hi):
+            w = stride * xx + jj - padding
+            col = (yy * WW + xx) * N
+            for i in range(N):
+                cols[row, col + i] = x[i, c, h, w]
+        for col in range((yy * WW + x_hi) * N, (yy + 1) * WW * N):
+            cols[row, col] = 0
+    for col in range(N * WW * y_hi, N * WW * HH):
+        cols[row, col] = 0
 
-def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
+
+def col2im_cython(const DTYPE_t[:, :] cols, int N, int C, int H, int W,
                   int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
-                                        dtype=cols.dtype)
+    x = np.zeros((N, C, H, W), dtype=np.asarray(cols).dtype)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    cdef const DTYPE_t[:, ::1] cols_c = np.ascontiguousarray(cols)
 
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
+    col2im_cython_inner(cols_c, x_view, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
-    if padding > 0:
-        return x_padded[:, :, padding:-padding, padding:-padding]
-    return x_padded
-
-
-@cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
-        for ii in range(field_height):
-            for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
-                for yy in range(HH):
-                    for xx in range(WW):
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
-
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
-
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
-
-def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
-        int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
+    return x
+
+
+cdef void col2im_cython_inner(const DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) noexcept nogil:
+    cdef int c
+    for c in prange(C, schedule='static', num_threads=_num_threads):
+        _col2im_channel(cols, x, c, N, H, W, HH, WW, field_height,
+                        field_width, padding, stride)
+
+
+cdef void _col2im_channel(const DTYPE_t[:, ::1] cols, DTYPE_t[:, :, :, ::1] x,
+                          int c, int N, int H, int W, int HH, int WW,
+                          int field_height, int field_width, int padding,
+                          int stride) noexcept nogil:
+    # Accumulate the rows of cols for channel c into x[:, c]. For each output
+    # row yy the slice of cols it reads is small enough to stay in cache. The
+    # images are walked in blocks of 8: within a block the reads from cols
+    # are contiguous, while x is written to only 8 planes at a time. Writing
+    # to all N planes at once is slow because their addresses are a large
+    # power of two apart for power-of-two image sizes, so they compete for
+    # the same cache sets; 8 is below the associativity of common L1 caches.
+    cdef int ii, jj, row, yy, xx, i, h, col, i0, i1
+    cdef int y_lo, y_hi, x_lo, x_hi
+
+    for ii in range(field_height):
+        y_lo = _first_valid(ii, padding, stride)
+        y_hi = _end_valid(ii, padding, stride, H, HH)
+        for jj in range(field_width):
+            x_lo = _first_valid(jj, padding, stride)
+            x_hi = _end_valid(jj, padding, stride, W, WW)
+            row = (c * field_height + ii) * field_width + jj
+            for yy in range(y_lo, y_hi):
+                h = stride * yy + ii - padding
+                col = yy * WW * N
+                for i0 in range(0, N, 8):
+                    i1 = i0 + 8 if i0 + 8 < N else N
+                    for xx in range(x_lo, x_hi):
+                        for i in range(i0, i1):
+                            x[i, c, h, stride * xx + jj - padding] += \
+                                cols[row, col + xx * N + i]
+
+
+cdef void col2im_6d_cython_inner(const DTYPE_t[:, :, :, :, :, ::1] cols,
+                                 DTYPE_t[:, :, :, ::1] x,
+                                 int N, int C, int H, int W, int HH, int WW,
+                                 int out_h, int out_w, int pad,
+                                 int stride) noexcept nogil:
+    cdef int plane
+    for plane in prange(N * C, schedule='static', num_threads=_num_threads):
+        _col2im_6d_plane(cols, x, plane / C, plane % C, H, W, HH, WW,
+                         out_h, out_w, pad, stride)
+
+
+cdef void _col2im_6d_plane(const DTYPE_t[:, :, :, :, :, ::1] cols,
+                           DTYPE_t[:, :, :, ::1] x, int n, int c,
+                           int H, int W, int HH, int WW, int out_h, int out_w,
+                           int pad, int stride) noexcept nogil:
+    # Accumulate into the image plane x[n, c]; both x and cols are walked
+    # along their last axis in the innermost loop.
+    cdef int hh, ww, h, w, y_lo, y_hi, x_lo, x_hi
+
+    for hh in range(HH):
+        y_lo = _first_valid(hh, pad, stride)
+        y_hi = _end_valid(hh, pad, stride, H, out_h)
+        for ww in range(WW):
+            x_lo = _first_valid(ww, pad, stride)
+            x_hi = _end_valid(ww, pad, stride, W, out_w)
+            for h in range(y_lo, y_hi):
+                for w in range(x_lo, x_hi):
+                    x[n, c, stride * h + hh - pad, stride * w + ww - pad] += \
+                        cols[c, hh, ww, n, h, w]
+
+
+def col2im_6d_cython(const DTYPE_t[:, :, :, :, :, :] cols, int N, int C, int H,
+                     int W, int HH, int WW, int pad, int stride):
     cdef int out_h = (H + 2 * pad - HH) / stride + 1
     cdef int out_w = (W + 2 * pad - WW) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
-                                                  dtype=cols.dtype)
-
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    x = np.zeros((N, C, H, W), dtype=np.asarray(cols).dtype)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    cdef const DTYPE_t[:, :, :, :, :, ::1] cols_c = np.ascontiguousarray(cols)
 
-    if pad > 0:
-        return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    col2im_6d_cython_inner(cols_c, x_view, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    return x
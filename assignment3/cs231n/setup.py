@@ -1,11 +1,22 @@
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
+import os
 import numpy
 
+# The kernels are parallelized with OpenMP. Compilers without OpenMP support
+# (such as Apple's clang) can build a single-threaded version with
+# CS231N_NO_OPENMP=1 python setup.py build_ext --inplace
+if os.environ.get('CS231N_NO_OPENMP'):
+  openmp_args = []
+else:
+  openmp_args = ['-fopenmp']
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = openmp_args,
+            extra_link_args = openmp_args,
   ),
 ]
 